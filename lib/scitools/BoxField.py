@@ -4,12 +4,15 @@ Class for a scalar (or vector) field over a BoxGrid or UniformBoxGrid grid.
 """
 
 from scitools.BoxGrid import BoxGrid, UniformBoxGrid, X, Y, Z
-from numpy import zeros, array, transpose
+from numpy import zeros, array, transpose, rollaxis, linspace, empty, \
+     concatenate, memmap, frombuffer, prod, multiply, arange, take
+import os, weakref
 
 import dolfin
 
 __all__ = ['BoxField', 'BoxGrid', 'UniformBoxGrid', 'X', 'Y', 'Z',
-           'dolfin_function2BoxField', 'update_from_dolfin_array']
+           'dolfin_function2BoxField', 'update_from_dolfin_array',
+           'decompose', 'halo_exchange', 'gather']
 
 
 class Field(object):
@@ -45,10 +48,13 @@ class BoxField(Field):
     =============      =============================================
     grid               reference to the underlying grid instance
     values             array holding field values at the grid points
+                       (allocated at first access)
+    filename           name of file with the values (None: in memory)
     =============      =============================================
 
     """
-    def __init__(self, grid, name, vector=0, **kwargs):
+    def __init__(self, grid, name, vector=0, filename=None, mode=None,
+                 **kwargs):
         """
         Initialize scalar or vector field over a BoxGrid/UniformBoxGrid.
 
@@ -59,6 +65,11 @@ class BoxField(Field):
         *name*             name of the field
         *vector*           scalar field if 0, otherwise the no of vector
                            components (spatial dimensions of vector field)
+        *filename*         store values in this file (as numpy.memmap)
+                           instead of in memory
+        *mode*             memmap mode: 'w+' (create or overwrite),
+                           'r+' (use existing values), 'r' (read-only);
+                           default: 'r+' if filename exists, else 'w+'
         *values*           (*kwargs*) optional array with field values
         =============      ===============================================
 
@@ -84,8 +95,22 @@ class BoxField(Field):
         suitable for Matlab-style visualization of 2D scalar fields.
         Also note how one can access the coordinates and u value at
         a point (i,j) in the grid.
+
+        The values array is not allocated before it is used. With a
+        filename, the values live in a file and only the parts that are
+        accessed are paged into memory::
+
+            v = BoxField(g, 'v', vector=3, filename='v.dat')
+            v.values[:,0,:,:] = 1   # only touches the x=x0 plane
+            v.flush()
         """
         Field.__init__(self, grid, name, **kwargs)
+        self.filename = filename
+        if mode is None:
+            mode = 'r+' if filename is not None and os.path.isfile(filename) \
+                   else 'w+'
+        self.mode = mode
+        self._values = None
 
         if vector > 0:
             # for a vector field we add a "dimension" in values for
@@ -98,20 +123,40 @@ class BoxField(Field):
         if 'values' in kwargs:
             values = kwargs['values']
             self.set_values(values)
-        else:
-            # create array of scalar field grid point values:
-            self.values = zeros(self.required_shape)
+        # else: the values array is allocated at first access
 
         # doesn't  work: self.__getitem__ = self.values.__getitem__
         #self.__setitem__ = self.values.__setitem__
 
+    def _get_values(self):
+        if self._values is None:
+            # create array of scalar field grid point values:
+            if self.filename is None:
+                self._values = zeros(self.required_shape)
+            else:
+                self._values = memmap(self.filename, dtype=float,
+                                      mode=self.mode,
+                                      shape=tuple(self.required_shape))
+        return self._values
+
+    def _set_values(self, values):
+        self._values = values
+
+    values = property(fget=_get_values, fset=_set_values,
+                      doc='array with field values at the grid points')
+
+    def flush(self):
+        """Write changes to the values file (if filename was given)."""
+        if isinstance(self._values, memmap):
+            self._values.flush()
+
     def copy_values(self, values):
         """Take a copy of the values array and reshape it if necessary."""
         self.set_values(values.copy())
 
     def set_values(self, values):
         """Attach the values array to this BoxField object."""
-        if values.shape == self.required_shape:
+        if values.shape == tuple(self.required_shape):
             self.values = values  # field data are provided
         else:
             try:
@@ -134,15 +179,123 @@ class BoxField(Field):
     def __setitem__(self, i, v):  self.values[i] = v
 
     def __str__(self):
-        if len(self.values.shape) > self.grid.nsd:
-            s = 'Vector field with %d components' % self.values.shape[-1]
+        if len(self.required_shape) > self.grid.nsd:
+            s = 'Vector field with %d components' % self.required_shape[0]
         else:
             s = 'Scalar field'
         s += ', over ' + str(self.grid)
         return s
 
+    def apply_stencil(self, stencil, out=None, boundary=None):
+        """
+        Apply a finite difference stencil to the field values.
+        stencil is a dictionary (or a list of pairs) mapping index
+        offsets (nsd-tuples, or ints in 1D) to weights, e.g., the
+        5-point Laplacian (times h**2) in 2D::
+
+            laplace = {(0,0): -4, (1,0): 1, (-1,0): 1, (0,1): 1, (0,-1): 1}
+            lu = u.apply_stencil(laplace)
+
+        The stencil is applied with array slices at all points where
+        it fits inside the grid; the remaining points (the boundary
+        and, for wide stencils, the layers inside it) get the values
+        of the field (or keep the values in out, if out is given).
+        If boundary is given, the values at the boundary points
+        (grid.indices('all_boundary')) are then set to boundary, which
+        is either a number or a function of the (vectorized) coordinates.
+        The result is stored in out (if given) and returned.
+        """
+        if isinstance(stencil, dict):
+            stencil = stencil.items()
+        nsd = self.grid.nsd
+        stencil = [((offset,) if isinstance(offset, int) else tuple(offset),
+                    weight) for offset, weight in stencil]
+        for offset, weight in stencil:
+            if len(offset) != nsd:
+                raise ValueError('offset %s in stencil must have %d '
+                                 'elements' % (offset, nsd))
+        values = self.values
+        prefix = (slice(None),)*(values.ndim - nsd)
+        # region where the stencil fits inside the grid:
+        lower = [max(0, -min([o[i] for o, w in stencil])) for i in range(nsd)]
+        upper = [max(0, max([o[i] for o, w in stencil])) for i in range(nsd)]
+        region = prefix + tuple([slice(l, n - u) for l, u, n in
+                                 zip(lower, upper, self.grid.shape)])
+        if out is None:
+            out = values.copy()
+        elif out is values:
+            raise ValueError('out cannot be the values array of the field')
+        result = out[region]
+        tmp = empty(result.shape)
+        for k, (offset, weight) in enumerate(stencil):
+            shifted = prefix + tuple([slice(l + o, n - u + o) for l, u, n, o
+                                      in zip(lower, upper, self.grid.shape,
+                                             offset)])
+            if k == 0:
+                multiply(values[shifted], weight, result)
+            else:
+                multiply(values[shifted], weight, tmp)
+                result += tmp
+
+        if boundary is not None:
+            indices = self.grid.indices('all_boundary')
+            if callable(boundary):
+                boundary = boundary(*[c[i] for c, i in
+                                      zip(self.grid.coor, indices)])
+            out[prefix + indices] = boundary
+        return out
+
+    def restrict(self, grid=None):
+        """
+        Return the field restricted to a coarser grid (default:
+        self.grid.coarsen()) by full weighting: (1/4, 1/2, 1/4)
+        weights in each direction in the interior, and injection
+        at the boundary.
+        """
+        if grid is None:
+            grid = self.grid.coarsen()
+        values = self.values
+        nsd = self.grid.nsd
+        for axis in range(values.ndim - nsd, values.ndim):
+            values = _restrict_axis(values, axis)
+        return self._new_field(grid, values)
+
+    def prolong(self, grid=None):
+        """
+        Return the field prolongated to a finer grid (default:
+        self.grid.refine()) by multilinear interpolation.
+        """
+        if grid is None:
+            grid = self.grid.refine()
+        values = self.values
+        nsd = self.grid.nsd
+        for axis in range(values.ndim - nsd, values.ndim):
+            values = _prolong_axis(values, axis)
+        return self._new_field(grid, values)
+
+    def _new_field(self, grid, values):
+        if values.shape[values.ndim - grid.nsd:] != tuple(grid.shape):
+            raise ValueError('grid %s is not a coarser/finer version of %s'
+                             % (grid, self.grid))
+        ncomponents = values.shape[0] if values.ndim > grid.nsd else 0
+        return BoxField(grid, self.name, vector=ncomponents, values=values)
+
+    def interpolate(self, points):
+        """
+        Return the field values n-linearly interpolated at the points
+        in the (npoints, nsd) array points (see
+        UniformBoxGrid.interpolate_points). For a vector field the
+        result has shape (ncomponents, npoints), otherwise (npoints,).
+        """
+        if self.values.ndim > self.grid.nsd:
+            # vector field: the components are the first index
+            values = rollaxis(self.values, 0, self.values.ndim)
+            return self.grid.interpolate_points(values, points).transpose()
+        else:
+            return self.grid.interpolate_points(self.values, points)
+
     def gridline(self, start_coor, direction=0, end_coor=None,
-                 snap=True):
+                 snap=True, npoints=None):
         """
         Return a coordinate array and corresponding field values
         along a line starting with start_coor, in the given
@@ -154,7 +307,10 @@ class BoxField(Field):
         fixed_coor differs from coordinates in start_coor.
 
         If snap is True, the line is snapped onto the grid, otherwise
-        values along the line must be interpolated (not yet implemented).
+        values along the line are interpolated (at the grid coordinates
+        in the given direction, plus the start and end points).
+        If npoints is given, the line is resampled at npoints
+        uniformly distributed points (by interpolation).
 
         >>> g2 = UniformBoxGrid.init_fromstring('[-1,1]x[-1,2] [0:3]x[0:4]')
         >>> print g2
@@ -174,21 +330,52 @@ class BoxField(Field):
         >>> print fixed_coor, snapped
         [0.5] False
         >>> #plot(xc, uc, title='u(x, y=%g)' % fixed_coor)
+        >>> xc, uc, fixed_coor, snapped = u.gridline((-1,0.6), 0, snap=False)
+        >>> print uc
+        [-0.4         0.26666667  0.93333333  1.6       ]
         """
-        if not snap:
-            raise NotImplementedError('Use snap=True, no interpolation impl.')
-
-        slice_index, snapped = \
-             self.grid.gridline_slice(start_coor, direction, end_coor)
-        fixed_coor = [self.grid[s][i] for s,i in enumerate(slice_index) \
-                      if not isinstance(i, slice)]
+        if snap:
+            slice_index, snapped = \
+                 self.grid.gridline_slice(start_coor, direction, end_coor)
+            fixed_coor = [self.grid[s][i] for s,i in enumerate(slice_index) \
+                          if not isinstance(i, slice)]
+            coor = self.grid.coor[direction][slice_index[direction].start:\
+                                             slice_index[direction].stop]
+            if npoints is None:
+                if len(fixed_coor) == 1:
+                    fixed_coor = fixed_coor[0]  # avoid list of length 1
+                return coor, self.values[slice_index], fixed_coor, snapped
+            start = array([self.grid[s][i] if not isinstance(i, slice)
+                           else coor[0] for s,i in enumerate(slice_index)])
+            end = coor[-1]
+        else:
+            snapped = False
+            if isinstance(start_coor, (int,float)):
+                start_coor = [start_coor]
+            start = array(start_coor, float)
+            fixed_coor = [c for i,c in enumerate(start) if i != direction]
+            if end_coor is None:
+                end = self.grid.max_coor[direction]
+            else:
+                end = end_coor[direction] \
+                      if not isinstance(end_coor, (int,float)) else end_coor
+        if npoints is None:
+            # grid coordinates between the start and end points:
+            coor = self.grid.coor[direction]
+            tol = self.grid.tolerance
+            coor = concatenate(([start[direction]],
+                coor[(coor > start[direction] + tol) & (coor < end - tol)],
+                [end]))
+        else:
+            coor = linspace(start[direction], end, npoints)
+        points = empty((len(coor), self.grid.nsd))
+        points[:] = start
+        points[:,direction] = coor
         if len(fixed_coor) == 1:
             fixed_coor = fixed_coor[0]  # avoid returning list of length 1
-        return self.grid.coor[direction][slice_index[direction].start:\
-                                         slice_index[direction].stop], \
-               self.values[slice_index], fixed_coor, snapped
+        return coor, self.interpolate(points), fixed_coor, snapped
 
-    def gridplane(self, value, constant_coor=0, snap=True):
+    def gridplane(self, value, constant_coor=0, snap=True, npoints=None):
         """
         Return two one-dimensional coordinate arrays and
         corresponding field values over a plane where one coordinate,
@@ -196,39 +383,210 @@ class BoxField(Field):
 
         If snap is True, the plane is snapped onto a grid plane such
         that the points in the plane coincide with the grid points.
-        Otherwise, the returned values must be interpolated (not yet impl.).
+        Otherwise, the returned values are interpolated in the
+        constant_coor direction.
+        If npoints (int or 2-tuple) is given, the plane is resampled
+        at npoints x npoints (or npoints[0] x npoints[1]) uniformly
+        distributed points (by interpolation).
         """
-        if not snap:
-            raise NotImplementedError('Use snap=True, no interpolation impl.')
-
         slice_index, snapped = self.grid.gridplane_slice(value, constant_coor)
-        if constant_coor == 0:
-            x = self.grid.coor[1]
-            y = self.grid.coor[2]
-        elif constant_coor == 1:
-            x = self.grid.coor[0]
-            y = self.grid.coor[2]
-        elif constant_coor == 2:
-            x = self.grid.coor[0]
-            y = self.grid.coor[1]
-        fixed_coor = self.grid.coor[constant_coor][slice_index[constant_coor]]
-        return x, y, self.values[slice_index], fixed_coor, snapped
-
-def _rank12rankd_mesh(a, shape):
+        dirs = [i for i in range(self.grid.nsd) if i != constant_coor]
+        if snap:
+            fixed_coor = \
+                 self.grid.coor[constant_coor][slice_index[constant_coor]]
+        else:
+            fixed_coor, snapped = value, False
+        if npoints is None:
+            x = self.grid.coor[dirs[0]]
+            y = self.grid.coor[dirs[1]]
+            if snap:
+                return x, y, self.values[slice_index], fixed_coor, snapped
+        else:
+            if isinstance(npoints, int):
+                npoints = (npoints, npoints)
+            x, y = [linspace(self.grid.min_coor[d], self.grid.max_coor[d], n)
+                    for d, n in zip(dirs, npoints)]
+        points = empty((len(x), len(y), self.grid.nsd))
+        points[:,:,constant_coor] = fixed_coor
+        points[:,:,dirs[0]] = x[:,None]
+        points[:,:,dirs[1]] = y[None,:]
+        values = self.interpolate(points.reshape(-1, self.grid.nsd))
+        values = values.reshape(values.shape[:-1] + (len(x), len(y)))
+        return x, y, values, fixed_coor, snapped
+
+def _axis_slice(a, axis, s):
+    """Return index tuple for a[..., s, ...] with s in position axis."""
+    index = [slice(None)]*a.ndim
+    index[axis] = s
+    return tuple(index)
+
+def _restrict_axis(a, axis):
+    """Full weighting restriction of array a along one axis."""
+    n = a.shape[axis]
+    if n % 2 == 0 or n < 3:
+        raise ValueError('cannot restrict %d points (%d cells)' % (n, n-1))
+    s = lambda start, stop: _axis_slice(a, axis, slice(start, stop, 2))
+    r = a[s(0, n)].copy()  # injection (kept at the boundary)
+    r[_axis_slice(r, axis, slice(1, -1))] = \
+         0.25*a[s(1, n-2)] + 0.5*a[s(2, n-1)] + 0.25*a[s(3, n)]
+    return r
+
+def _prolong_axis(a, axis):
+    """Linear interpolation of array a to a twice as fine grid."""
+    shape = list(a.shape)
+    shape[axis] = 2*shape[axis] - 1
+    p = empty(shape)
+    p[_axis_slice(p, axis, slice(0, None, 2))] = a
+    p[_axis_slice(p, axis, slice(1, None, 2))] = \
+         0.5*(a[_axis_slice(a, axis, slice(0, -1))] +
+              a[_axis_slice(a, axis, slice(1, None))])
+    return p
+
+def decompose(field, nparts, ghost=1):
+    """
+    Split a BoxField into pieces for parallel computing, see
+    UniformBoxGrid.decompose for nparts and ghost. Return a list of
+    BoxField objects over the subgrids, with values initialized
+    from field. The values of all pieces are stored in one block
+    of shared memory, so processes forked afterwards (e.g., by
+    multiprocessing on Unix) work on the same data as the parent.
+    Each piece has two extra attributes: global_index (slices of
+    the piece's points in field.values) and owned (slices of the
+    points owned by the piece in piece.values).
+
+    Typical use: each process updates the owned points of a piece,
+    calls halo_exchange(pieces, part) after all processes are done
+    (e.g., after a multiprocessing.Barrier-like synchronization), and
+    the parent finally calls gather(pieces, field).
+    """
+    import mmap
+    parts = field.grid.decompose(nparts, ghost)
+    ncomponents = list(field.required_shape[:len(field.required_shape) -
+                                            field.grid.nsd])
+    prefix = (slice(None),)*len(ncomponents)
+    sizes = [int(prod(ncomponents + list(subgrid.shape)))
+             for subgrid, global_slices, owned_slices in parts]
+    data = frombuffer(mmap.mmap(-1, 8*sum(sizes)), float)
+    pieces = []
+    offset = 0
+    for (subgrid, global_slices, owned_slices), size in zip(parts, sizes):
+        piece = BoxField(subgrid, field.name,
+                         vector=ncomponents[0] if ncomponents else 0,
+                         values=data[offset:offset+size])
+        offset += size
+        piece.global_index = prefix + global_slices
+        piece.owned = prefix + owned_slices
+        piece.values[...] = field.values[piece.global_index]
+        pieces.append(piece)
+    return pieces
+
+def _owned_region(piece):
+    """Return start and stop indices of a piece's owned points."""
+    k = len(piece.owned) - piece.grid.nsd
+    return [g.start + o.start for g, o in zip(piece.global_index[k:],
+                                              piece.owned[k:])], \
+           [g.start + o.stop for g, o in zip(piece.global_index[k:],
+                                             piece.owned[k:])]
+
+def halo_exchange(pieces, part=None):
+    """
+    Update the ghost points in pieces (from decompose) with the values
+    from the pieces that own them. If part is given, only the ghost
+    points of pieces[part] are updated (such that each process can
+    update its own piece).
+    """
+    targets = pieces if part is None else [pieces[part]]
+    for p in targets:
+        k = len(p.global_index) - p.grid.nsd
+        prefix = p.global_index[:k]
+        p_slices = p.global_index[k:]
+        for q in pieces:
+            if q is p:
+                continue
+            q_slices = q.global_index[k:]
+            # the points owned by q and stored in p:
+            q_lo, q_hi = _owned_region(q)
+            lo = [max(s.start, l) for s, l in zip(p_slices, q_lo)]
+            hi = [min(s.stop, h) for s, h in zip(p_slices, q_hi)]
+            if [l for l, h in zip(lo, hi) if l >= h]:
+                continue  # no overlap
+            p.values[prefix + tuple([slice(l - s.start, h - s.start)
+                                     for l, h, s in zip(lo, hi, p_slices)])] = \
+            q.values[prefix + tuple([slice(l - s.start, h - s.start)
+                                     for l, h, s in zip(lo, hi, q_slices)])]
+
+def gather(pieces, field):
+    """Copy the owned values in pieces (from decompose) to field."""
+    for p in pieces:
+        k = len(p.global_index) - p.grid.nsd
+        lo, hi = _owned_region(p)
+        field.values[p.global_index[:k] +
+                     tuple([slice(l, h) for l, h in zip(lo, hi)])] = \
+                     p.values[p.owned]
+    return field
+
+def _rank12rankd_mesh(a, shape, ncomponents=0):
     """
     Given rank 1 array a with values in a mesh with the no of points
     described by shape, transform the array to the right "mesh array"
-    with the same shape.
+    with the same shape. If ncomponents > 0, a holds ncomponents
+    such arrays after each other (a vector field), and the returned
+    array has the components as first index.
+    The returned array is a view of a (no copy) if a is contiguous.
     """
     shape = list(shape)
     shape.reverse()
     if len(a.shape) == 1:
+        if ncomponents > 0:
+            return a.reshape([ncomponents] + shape).transpose(
+                _mesh_axes(len(shape), ncomponents))
         return a.reshape(shape).transpose()
     else:
         raise ValueError('array a cannot be multi-dimensional (not %s), ' \
                          'break it up into one-dimensional components' \
                          % a.shape)
 
+def _mesh_axes(nsd, ncomponents=0):
+    """Axes for transposing between mesh (DOLFIN) and grid order."""
+    axes = range(nsd-1, -1, -1)
+    if ncomponents > 0:
+        axes = [0] + [i+1 for i in axes]
+    return axes
+
+# cache for _vertex_order: function space -> permutation array
+# (weak references, such that the cache does not keep function
+# spaces and their arrays alive)
+_vertex_order_cache = weakref.WeakKeyDictionary()
+
+def _vertex_order(function_space):
+    """
+    Return the permutation of degrees of freedom to vertex numbering
+    for function_space, such that values[_vertex_order(V)] are the
+    values in vertex order. The permutation is computed once for each
+    function space and cached.
+    """
+    try:
+        return _vertex_order_cache[function_space]
+    except KeyError:
+        pass
+    except TypeError:
+        # no weak references to function_space, look for the
+        # permutation stored on the object itself
+        v2d = getattr(function_space, '_scitools_vertex_order', None)
+        if v2d is not None:
+            return v2d
+    d2v = dolfin.dof_to_vertex_map(function_space)
+    v2d = empty(len(d2v), int)
+    v2d[d2v] = arange(len(d2v))  # inverse of d2v
+    try:
+        _vertex_order_cache[function_space] = v2d
+    except TypeError:
+        try:
+            function_space._scitools_vertex_order = v2d
+        except AttributeError:
+            pass  # cannot be cached
+    return v2d
+
 def dolfin_mesh2UniformBoxGrid(dolfin_mesh, division=None):
     """
     Turn a regular, structured DOLFIN finite element mesh into
@@ -310,13 +668,13 @@ u2 = interpolate(u, V2)
 
 """ % (str(dolfin_function.ufl_element()), dolfin_function.ufl_element().degree()))
 
+    # (vector().array() returns a copy of the values in the vector)
     if dolfin.__version__[:3] == "1.0":
-        nodal_values = dolfin_function.vector().array().copy()
+        nodal_values = dolfin_function.vector().array()
     else:
-        #map = dolfin_function.function_space().dofmap().vertex_to_dof_map(dolfin_mesh)
-        d2v = dolfin.dof_to_vertex_map(dolfin_function.function_space())
-        nodal_values = dolfin_function.vector().array().copy()
-        nodal_values[d2v] = dolfin_function.vector().array().copy()
+        # one gather with the (cached) dof to vertex permutation
+        nodal_values = dolfin_function.vector().array()[
+            _vertex_order(dolfin_function.function_space())]
 
     if uniform_mesh:
         grid = dolfin_mesh2UniformBoxGrid(dolfin_mesh, division)
@@ -330,10 +688,8 @@ u2 = interpolate(u, V2)
             nodal_values.shape = (ncomponents, grid.npoints)
         except ValueError as e:
             raise ValueError('Vector field (nodal_values) has length %d, there are %d grid points, and this does not match with %d components' % (nodal_values.size, grid.npoints, ncomponents))
-        vector_field = [_rank12rankd_mesh(nodal_values[i,:].copy(),
-                                          grid.shape) \
-                        for i in range(ncomponents)]
-        nodal_values = array(vector_field)
+        nodal_values = _rank12rankd_mesh(nodal_values.ravel(), grid.shape,
+                                         ncomponents)  # (view)
         bf = BoxField(grid, name=dolfin_function.name(),
                       vector=ncomponents, values=nodal_values)
     else:
@@ -345,22 +701,41 @@ u2 = interpolate(u, V2)
                       vector=0, values=nodal_values)
     return bf
 
-def update_from_dolfin_array(dolfin_array, box_field):
+def update_from_dolfin_array(dolfin_array, box_field, function_space=None):
     """
     Update the values in a BoxField object box_field with a new
     DOLFIN array (dolfin_array). The array must be reshaped and
     transposed in the right way
     (therefore box_field.copy_values(dolfin_array) will not work).
+    If function_space is given, dolfin_array is in dof order (e.g.,
+    u.vector().array()) and is permuted to vertex order (the
+    permutation is cached).
+
+    The values are written into the existing box_field.values array.
+    For a box_field made by dolfin_function2BoxField this is a single
+    copy (or gather, with function_space) and no temporary arrays.
     """
-    nodal_values = dolfin_array.copy()
-    if len(nodal_values.shape) > 1:
+    if len(dolfin_array.shape) > 1:
         raise NotImplementedError # no support for vector valued functions yet
                                   # the problem is in _rank12rankd_mesh
-    try:
-        nodal_values = _rank12rankd_mesh(nodal_values, box_field.grid.shape)
-    except ValueError as e:
-        raise ValueError('DOLFIN function has vector of size %s while the provided mesh demands %s' % (nodal_values.size, grid.shape))
-    box_field.set_values(nodal_values)
+    values = box_field.values
+    if dolfin_array.size != values.size:
+        raise ValueError('DOLFIN function has vector of size %s while the provided mesh demands %s' % (dolfin_array.size, box_field.grid.shape))
+    nsd = box_field.grid.nsd
+    ncomponents = values.shape[0] if values.ndim > nsd else 0
+    # values in mesh order (a view of values):
+    mesh_values = values.transpose(_mesh_axes(nsd, ncomponents))
+    if mesh_values.flags.c_contiguous:
+        flat = mesh_values.reshape(-1)  # view, since contiguous
+        if function_space is not None:
+            take(dolfin_array, _vertex_order(function_space), out=flat)
+        else:
+            flat[:] = dolfin_array
+    else:
+        if function_space is not None:
+            dolfin_array = dolfin_array[_vertex_order(function_space)]
+        values[...] = _rank12rankd_mesh(dolfin_array, box_field.grid.shape,
+                                        ncomponents)
     return box_field
 
 def _test(g):
@@ -3,9 +3,12 @@
 Class for uniform and non-uniform grid on an interval, rectangle, or box.
 """
 
+import itertools
 from scitools.errorcheck import right_type, wrong_type
 from scitools.numpyutils import ndgrid, ndarray, wrap2callable, array, \
-     zeros, linspace
+     zeros, linspace, asarray, where, newaxis, empty, searchsorted, \
+     minimum, broadcast_arrays, isscalar, unravel_index, frombuffer, \
+     arange, unique, concatenate
 
 # constants for indexing the space directions:
 X = X1 = 0
@@ -31,7 +34,8 @@ class UniformBoxGrid(object):
                        the j-th coordinate in direction Y (=1)
                        X, Y, Z are predefined constants 0, 1, 2
     coorv              expanded version of coor for vectorized expressions
-                       (in 2D, self.coorv[0] = self.coor[0][:,newaxis])
+                       (in 2D, self.coorv[0] = self.coor[0][:,newaxis]),
+                       made on first access
     tolerance          small geometric tolerance based on grid coordinates
     npoints            total number of grid points
     =============      ====================================================
@@ -80,7 +84,6 @@ class UniformBoxGrid(object):
         self.max_coor = array(max, float)
         self.dirnames = dirnames
         self.division = division
-        self.coor = [None]*self.nsd
         self.shape = [0]*self.nsd
         self.delta = zeros(self.nsd)
 
@@ -88,16 +91,20 @@ class UniformBoxGrid(object):
             self.delta[i] = \
                  (self.max_coor[i] -  self.min_coor[i])/float(self.division[i])
             self.shape[i] = self.division[i] + 1  # no of grid points
-            self.coor[i] = \
-                 linspace(self.min_coor[i], self.max_coor[i], self.shape[i])
+        self.coor = self._make_coor()
         self._more_init()
 
+    def _make_coor(self):
+        """Return the list of coordinates in each space direction."""
+        return [linspace(self.min_coor[i], self.max_coor[i], self.shape[i])
+                for i in range(self.nsd)]
+
     def _more_init(self):
         self.shape = tuple(self.shape)
-        self.coorv = ndgrid(*self.coor)
-        if not isinstance(self.coorv, (list,tuple)):
-            # 1D grid, wrap self.coorv as list:
-            self.coorv = [self.coorv]
+        # coorv arrays (of the size of the grid) made from previous
+        # coordinates are dropped and made from self.coor when needed
+        for name in self._lazy_names():
+            self.__dict__.pop(name, None)
 
         self.npoints = 1
         for i in range(len(self.shape)):
@@ -105,24 +112,51 @@ class UniformBoxGrid(object):
 
         self.tolerance = (max(self.max_coor) - min(self.min_coor))*1E-14
 
-        # nicknames: xcoor, ycoor, xcoorv, ycoorv, etc
+        # nicknames: xcoor, ycoor, etc (and xcoorv, ycoorv, etc
+        # in __getattr__)
         for i in range(self.nsd):
             self.__dict__[self.dirnames[i]+'coor'] = self.coor[i]
-            self.__dict__[self.dirnames[i]+'coorv'] = self.coorv[i]
 
-        if self.nsd == 3:
+    _boundary_names = ('ycoorv_xfixed_boundary', 'zcoorv_xfixed_boundary',
+                       'xcoorv_yfixed_boundary', 'zcoorv_yfixed_boundary')
+
+    def _lazy_names(self):
+        """Names of the attributes made in __getattr__."""
+        return ['coorv'] + [name + 'coorv' for name in self.dirnames] + \
+               list(self._boundary_names)
+
+    def __getattr__(self, name):
+        # (only called when name is not a set attribute)
+        if name.startswith('__') or 'coor' not in self.__dict__ or \
+           name not in self._lazy_names():
+            raise AttributeError(name)
+        if name == 'coorv':
+            coorv = ndgrid(*self.coor)
+            if not isinstance(coorv, (list,tuple)):
+                # 1D grid, wrap coorv as list:
+                coorv = [coorv]
+            self.coorv = coorv
+        elif name in self._boundary_names:
+            if self.nsd != 3:
+                raise AttributeError(name)
             # make boundary coordinates for vectorization:
+            x, y, z = self.coor
             xdummy, \
             self.ycoorv_xfixed_boundary, \
-            self.zcoorv_xfixed_boundary = ndgrid(0, self.ycoor, self.zcoor)
+            self.zcoorv_xfixed_boundary = ndgrid(0, y, z)
 
             self.xcoorv_yfixed_boundary, \
             ydummy, \
-            self.zcoorv_yfixed_boundary = ndgrid(self.xcoor, 0, self.zcoor)
+            self.zcoorv_yfixed_boundary = ndgrid(x, 0, z)
 
             self.xcoorv_yfixed_boundary, \
             self.zcoorv_yfixed_boundary, \
-            zdummy = ndgrid(self.xcoor, self.ycoor, 0)
+            zdummy = ndgrid(x, y, 0)
+        else:
+            # nickname xcoorv, ycoorv, etc
+            self.__dict__[name] = \
+                self.coorv[list(self.dirnames).index(name[:-5])]
+        return self.__dict__[name]
 
     # could have _ in all variable names and define read-only
     # access via properties
@@ -296,17 +330,81 @@ class UniformBoxGrid(object):
         1.9660000000000002
         >>> f(0.1,0.234)        # exact answer
         1.9660000000000002
+
+        The returned function is vectorized: if the coordinates are
+        arrays, the interpolated values are returned as an array
+        (of the same shape). See also interpolate_points.
         """
-        args = self.coor
-        args.append(point_values)
-        # make use of wrap2callable, which applies ScientificPython
-        return wrap2callable(args)
+        self._compatible_values(point_values)
+        def interpolate(*coor):
+            if len(coor) != self.nsd:
+                raise TypeError('interpolator for %dD grid called with %d '
+                                'coordinates' % (self.nsd, len(coor)))
+            if all([isscalar(c) for c in coor]):
+                return self.interpolate_points(point_values, [coor])[0]
+            coor = broadcast_arrays(*coor)
+            points = empty((coor[0].size, self.nsd))
+            for i in range(self.nsd):
+                points[:,i] = coor[i].ravel()
+            v = self.interpolate_points(point_values, points)
+            return v.reshape(coor[0].shape + v.shape[1:])
+        return interpolate
 
-    def vectorized_eval(self, f):
+    def interpolate_points(self, point_values, points):
+        """
+        Interpolate point_values (array with values at the grid points)
+        n-linearly at the points in the (npoints, nsd) array points.
+        point_values may have extra trailing dimensions (e.g.,
+        point_values[i,j,:] for a vector at grid point (i,j)).
+        Return array of shape (npoints,) + point_values.shape[nsd:].
+
+        >>> g = UniformBoxGrid(min=(0,0), max=(1,1), division=(4,2))
+        >>> v = g.vectorized_eval(lambda x, y: 2 + x - 3*y)
+        >>> print g.interpolate_points(v, [(0.1,0.2), (1,1)])
+        [ 1.5  0. ]
+        """
+        self._compatible_values(point_values)
+        points = self._points_array(points)
+        index = self.locate_cells(points)[0]
+        # use the last cell also for points on the upper boundary:
+        index = minimum(index, asarray(self.shape) - 2)
+        weight = empty(points.shape)
+        for i in range(self.nsd):
+            coor = self.coor[i]
+            x = coor[index[:,i]]
+            weight[:,i] = (points[:,i] - x)/(coor[index[:,i]+1] - x)
+        # sum weighted values at the 2**nsd corners of the cells:
+        extra = (newaxis,)*(point_values.ndim - self.nsd)
+        values = 0
+        for corner in range(2**self.nsd):
+            w = 1
+            corner_index = []
+            for i in range(self.nsd):
+                if corner & (1 << i):
+                    w = w*weight[:,i]
+                    corner_index.append(index[:,i] + 1)
+                else:
+                    w = w*(1 - weight[:,i])
+                    corner_index.append(index[:,i])
+            values = values + w[(slice(None),) + extra]* \
+                     point_values[tuple(corner_index)]
+        return values
+
+    def vectorized_eval(self, f, chunk_size=None, nworkers=1, pool='thread'):
         """
         Evaluate a function f (of the space directions) over a grid.
         f is supposed to be vectorized.
 
+        If chunk_size is given, f is evaluated for slabs of chunk_size
+        grid planes (along the first axis) at a time, and the results
+        are filled into a preallocated array. This bounds the size of
+        the temporary arrays in f to the size of a slab, and the
+        coordinate arrays of the whole grid (coorv) are never made.
+        With nworkers > 1, the slabs are evaluated by a pool of
+        nworkers threads (pool='thread') or processes (pool='process',
+        Unix only: the processes are forked and fill an array in
+        shared memory, so f need not be picklable).
+
         >>> g = BoxGrid(x=(0,1), y=(0,1), nx=3, ny=3)
         >>> # f(x,y) = sin(x)*exp(x-y):
         >>> a = g.vectorized_eval(lambda x,y: sin(x)*exp(y-x))
@@ -324,26 +422,82 @@ class UniformBoxGrid(object):
          [ 2.  2.  2.  2.]
          [ 2.  2.  2.  2.]]
         """
-        a = f(*self.coorv)
+        if chunk_size is None and nworkers == 1:
+            a = f(*self.coorv)
+            self._check_vectorized(f, a, self.shape)
+            return a
+
+        n = self.shape[0]
+        if chunk_size is None:
+            chunk_size = max(1, n//(4*nworkers))
+        slabs = [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+        # evaluate the first slab to find the type of the values:
+        a = _eval_slab(f, self, slabs[0])
+        if nworkers > 1 and pool == 'process':
+            import mmap
+            nbytes = a.dtype.itemsize*self.npoints
+            values = frombuffer(mmap.mmap(-1, max(nbytes, 1)), a.dtype,
+                                self.npoints).reshape(self.shape)
+        else:
+            values = empty(self.shape, a.dtype)
+        values[slice(*slabs[0])] = a
+        slabs = slabs[1:]
+        if nworkers == 1:
+            for slab in slabs:
+                values[slice(*slab)] = _eval_slab(f, self, slab)
+        elif pool == 'thread':
+            from multiprocessing.pool import ThreadPool
+            workers = ThreadPool(nworkers)
+            try:
+                workers.map(lambda slab: _fill_slab(f, self, slab, values),
+                            slabs)
+            finally:
+                workers.close()
+        elif pool == 'process':
+            import multiprocessing
+            global _eval_state
+            _eval_state = (f, self, values)  # inherited by the processes
+            try:
+                workers = multiprocessing.Pool(nworkers)
+                try:
+                    workers.map(_fill_slab_from_state, slabs)
+                finally:
+                    workers.close()
+                    workers.join()
+            finally:
+                _eval_state = None
+        else:
+            raise ValueError('pool=%r, must be "thread" or "process"' % pool)
+        return values
 
-        # check if f is really vectorized:
+    def _check_vectorized(self, f, a, shape):
+        """Check that f returned an array a of the given shape."""
         try:
             msg = 'calling %s, which is supposed to be vectorized' % f.__name__
         except AttributeError:  # if __name__ is missing
             msg = 'calling a function, which is supposed to be vectorized'
-        try:
-            self.compatible(a)
-        except (IndexError,TypeError) as e:
-            print 'e=',e, type(e), e.__class__.__name__
-            raise e.__class__('BoxGrid.vectorized_eval(f):\n%s, BUT:\n%s' % \
-                              (msg, e))
-        return a
+        if not isinstance(a, ndarray):
+            e = TypeError('data is %s, not NumPy array' % type(a))
+        elif a.shape != shape:
+            e = IndexError("data of shape %s is not compatible with the "
+                           "grid's shape %s" % (a.shape, shape))
+        else:
+            return True
+        raise e.__class__('BoxGrid.vectorized_eval(f):\n%s, BUT:\n%s' % \
+                          (msg, e))
 
     def init_fromstring(s):
         data = UniformBoxGrid.string2griddata(s)
         return UniformBoxGrid(**data)
     init_fromstring = staticmethod(init_fromstring)
 
+    def _compatible_values(self, point_values):
+        """As compatible, but point_values may have extra trailing dims."""
+        if not isinstance(point_values, ndarray) or \
+           point_values.shape[:self.nsd] != self.shape:
+            self.compatible(point_values, 'point_values')
+        return True
+
     def compatible(self, data_array, name_of_data_array=''):
         """
         Check that data_array is a NumPy array with dimensions
@@ -375,125 +529,159 @@ class UniformBoxGrid(object):
         objects for the index slice in each direction.
         vectorized_version is false if the iterator visits each point
         at a time (scalar version).
+
+        The slices and indices are computed once per domain_part and
+        cached. See also the indices method.
         """
         self.iterator_domain = domain_part
         self.vectorized_iter = vectorized_version
         return self
 
     def __iter__(self):
-        # Idea: set up slices for the various self.iterator_domain
-        # values. In scalar mode, make a loop over the slices and
-        # yield the scalar value. In vectorized mode, return the
-        # appropriate slices.
+        """
+        If vectorized mode:
+        Return list of slice instances, where the i-th element in the
+        list represents the slice for the index in the i-th space
+        direction (0,...,nsd-1).
 
-        self._slices = []  # elements meant to be slice objects
+        If scalar mode:
+        Return tuple of indices (in multi-D) or the index (in 1D).
+        Each point is visited once (in the order of the values array),
+        also when the slices in vectorized mode overlap.
+        """
+        slices = self._domain_slices(self.iterator_domain)
+        if self.vectorized_iter:
+            for s in slices:
+                yield list(s)
+        elif len(slices) == 1:
+            # a box of points ('all', 'interior'), no index arrays needed
+            ranges = [xrange(s.start, s.stop) for s in slices[0]]
+            if self.nsd == 1:
+                for i in ranges[0]:
+                    yield i
+            else:
+                for i in itertools.product(*ranges):
+                    yield i
+        else:
+            # (overlapping) boundary slices, visit each point once:
+            indices = self.indices(self.iterator_domain)
+            if self.nsd == 1:
+                for i in indices[0]:
+                    yield int(i)
+            else:
+                for i in itertools.izip(*indices):
+                    yield tuple([int(j) for j in i])
 
-        if self.iterator_domain == 'all':
-            self._slices.append([])
+    def _domain_slices(self, domain_part):
+        """
+        Return (cached) list of slice lists, where each slice list
+        has a slice for each space direction and where the slice
+        lists together cover domain_part (see iter).
+        """
+        if not hasattr(self, '_slices_cache'):
+            self._slices_cache = {}
+        if domain_part in self._slices_cache:
+            return self._slices_cache[domain_part]
+
+        n = [len(c) for c in self.coor]
+        all_ = [slice(0, n[i], 1) for i in range(self.nsd)]
+        interior = [slice(1, n[i]-1, 1) for i in range(self.nsd)]
+        slices = []
+        if domain_part == 'all':
+            slices.append(all_)
+
+        elif domain_part == 'interior':
+            slices.append(interior)
+
+        elif domain_part in ('all_boundary', 'interior_boundary'):
+            other = all_ if domain_part == 'all_boundary' else interior
             for i in range(self.nsd):
-                self._slices[-1].append((i, slice(0, len(self.coor[i]), 1)))
+                # boundary i fixed at 0 and at its max value:
+                for i0 in (0, n[i]-1):
+                    slices.append(other[:])
+                    slices[-1][i] = slice(i0, i0+1, 1)
 
-        elif self.iterator_domain == 'interior':
-            self._slices.append([])
+        elif domain_part == 'corners':
+            slices = [[]]
             for i in range(self.nsd):
-                self._slices[-1].append((i, slice(1, len(self.coor[i])-1, 1)))
+                slices = [s + [slice(i0, i0+1, 1)]
+                          for s in slices for i0 in (0, n[i]-1)]
 
-        elif self.iterator_domain == 'all_boundary':
-            for i in range(self.nsd):
-                self._slices.append([])
-                # boundary i fixed at 0:
-                for j in range(self.nsd):
-                    if j != i:
-                        self._slices[-1].\
-                           append((j, slice(0, len(self.coor[j]), 1)))
-                    else:
-                        self._slices[-1].append((i, slice(0, 1, 1)))
-                # boundary i fixed at its max value:
-                for j in range(self.nsd):
-                    if j != i:
-                        self._slices[-1].\
-                           append((j, slice(0, len(self.coor[j]), 1)))
-                    else:
-                        n = len(self.coor[i])
-                        self._slices[-1].append((i, slice(n-1, n, 1)))
-
-        elif self.iterator_domain == 'interior_boundary':
+        elif domain_part in ('all_edges', 'interior_edges'):
+            self._check_edges(domain_part)
+            varying = all_ if domain_part == 'all_edges' else interior
             for i in range(self.nsd):
-                self._slices.append([])
-                # boundary i fixed at 0:
-                for j in range(self.nsd):
-                    if j != i:
-                        self._slices[-1].\
-                           append((j, slice(1, len(self.coor[j])-1, 1)))
-                    else:
-                        self._slices[-1].append((i, slice(0, 1, 1)))
-                # boundary i fixed at its max value:
-                for j in range(self.nsd):
-                    if j != i:
-                        self._slices[-1].\
-                           append((j, slice(1, len(self.coor[j])-1, 1)))
-                    else:
-                        n = len(self.coor[i])
-                        self._slices[-1].append((i, slice(n-1, n, 1)))
-
-        elif self.iterator_domain == 'corners':
-            if self.nsd == 1:
-                for i0 in (0, len(self.coor[0])-1):
-                    self._slices.append([])
-                    self._slices[-1].append((0, slice(i0, i0+1, 1)))
-            elif self.nsd == 2:
-                for i0 in (0, len(self.coor[0])-1):
-                    for i1 in (0, len(self.coor[1])-1):
-                        self._slices.append([])
-                        self._slices[-1].append((0, slice(i0, i0+1, 1)))
-                        self._slices[-1].append((0, slice(i1, i1+1, 1)))
-            elif self.nsd == 3:
-                for i0 in (0, len(self.coor[0])-1):
-                    for i1 in (0, len(self.coor[1])-1):
-                        for i2 in (0, len(self.coor[2])-1):
-                            self._slices.append([])
-                            self._slices[-1].append((0, slice(i0, i0+1, 1)))
-                            self._slices[-1].append((0, slice(i1, i1+1, 1)))
-                            self._slices[-1].append((0, slice(i2, i2+1, 1)))
-
-        elif self.iterator_domain == 'all_edges':
-            print 'iterator over "all_edges" is not implemented'
-        elif self.iterator_domain == 'interior_edges':
-            print 'iterator over "interior_edges" is not implemented'
+                # edge along direction i, the other two indices fixed:
+                j, k = [d for d in range(self.nsd) if d != i]
+                for j0 in (0, n[j]-1):
+                    for k0 in (0, n[k]-1):
+                        slices.append([None]*self.nsd)
+                        slices[-1][i] = varying[i]
+                        slices[-1][j] = slice(j0, j0+1, 1)
+                        slices[-1][k] = slice(k0, k0+1, 1)
         else:
-            raise ValueError('iterator over "%s" is not impl.' % \
-                             self.iterator_domain)
+            raise ValueError('iterator over "%s" is not impl.' % domain_part)
+        self._slices_cache[domain_part] = slices
+        return slices
 
-#    "def __next__(self):"
-        """
-        If vectorized mode:
-        Return list of slice instances, where the i-th element in the
-        list represents the slice for the index in the i-th space
-        direction (0,...,nsd-1).
+    def _check_edges(self, domain_part):
+        if self.nsd != 3:
+            raise ValueError('"%s" is only defined for 3D grids, not %dD' %
+                             (domain_part, self.nsd))
 
-        If scalar mode:
-        Return list of indices (in multi-D) or the index (in 1D).
+    def indices(self, domain_part='all', flat=False):
         """
-        if self.vectorized_iter:
-            for s in self._slices:
-                yield [slice_in_dir for dir, slice_in_dir in s]
+        Return index arrays for the grid points in domain_part
+        (see iter for legal values), suitable for fancy indexing
+        of arrays over the grid, e.g.,
+
+        >>> g = UniformBoxGrid(min=(0,0), max=(1,1), division=(3,3))
+        >>> u = zeros(g.shape)
+        >>> u[g.indices('all_boundary')] = 1
+        >>> print u
+        [[ 1.  1.  1.  1.]
+         [ 1.  0.  0.  1.]
+         [ 1.  0.  0.  1.]
+         [ 1.  1.  1.  1.]]
+
+        If flat is false, a tuple of nsd integer arrays is returned,
+        otherwise one array with indices in the flattened array over
+        the grid (for u.flat, u.ravel(), take, put, etc.).
+        Each point appears once, in the order of the array over the grid.
+        The arrays for the boundary parts are computed once and cached
+        (they must not be changed), while the arrays for 'all' and
+        'interior' (of the size of the grid) are computed in each call.
+        For these parts, slices (see iter) are more efficient.
+        """
+        if not hasattr(self, '_indices_cache'):
+            self._indices_cache = {}
+        key = (domain_part, flat)
+        if key in self._indices_cache:
+            return self._indices_cache[key]
+        if flat:
+            slices = self._domain_slices(domain_part)
+            index = [self._flat_indices(s) for s in slices]
+            if len(index) == 1:
+                index = index[0]
+            else:
+                # (the slices of the boundary parts overlap)
+                index = unique(concatenate(index))
         else:
-            # scalar version
-            for s in self._slices:
-                slices = [slice_in_dir for dir, slice_in_dir in s]
-                if len(slices) == 1:
-                    for i in xrange(slices[0].start, slices[0].stop):
-                        yield i
-                elif len(slices) == 2:
-                    for i in xrange(slices[0].start, slices[0].stop):
-                        for j in xrange(slices[1].start, slices[1].stop):
-                            yield [i, j]
-                elif len(slices) == 3:
-                    for i in xrange(slices[0].start, slices[0].stop):
-                        for j in xrange(slices[1].start, slices[1].stop):
-                            for k in xrange(slices[2].start, slices[2].stop):
-                                yield [i, j, k]
+            index = unravel_index(self.indices(domain_part, flat=True),
+                                  self.shape)
+        if domain_part not in ('all', 'interior'):
+            self._indices_cache[key] = index
+        return index
 
+    def _flat_indices(self, slices):
+        """
+        Return the indices in the flattened array over the grid
+        of the points in the box given by slices (one per direction).
+        """
+        index = zeros(1, int)
+        for n, s in zip(self.shape, slices):
+            index = (index[:,newaxis]*n + arange(s.start, s.stop)).ravel()
+        return index
 
     def locate_cell(self, point):
         """
@@ -555,7 +743,7 @@ class UniformBoxGrid(object):
             if coor < self.min_coor[i] or coor > self.max_coor[i]:
                 raise ValueError(
                     'locate_cell: point=%s is outside the domain [%s,%s]' % \
-                    point, self.min_coor[i], self.max_coor[i])
+                    (point, self.min_coor[i], self.max_coor[i]))
             index[i] = int((coor - self.min_coor[i])//self.delta[i])  # (need integer division)
             distance[i] = coor - (self.min_coor[i] + index[i]*self.delta[i])
             if distance[i] > self.delta[i]/2:
@@ -574,6 +762,55 @@ class UniformBoxGrid(object):
 
         return index, distance, grid_point, nearest_point
 
+    def _points_array(self, points):
+        """Return points as an (npoints, nsd) array (for locate_cells)."""
+        points = asarray(points, float)
+        if self.nsd == 1 and points.ndim == 1:
+            points = points[:,newaxis]
+        if points.ndim != 2 or points.shape[1] != self.nsd:
+            raise ValueError('points array of shape %s, must be (npoints, %d)'
+                             % (points.shape, self.nsd))
+        outside = ((points < self.min_coor) | \
+                   (points > self.max_coor)).any(axis=1)
+        if outside.any():
+            raise ValueError(
+                'locate_cells: %d points are outside the domain, e.g., %s' % \
+                (outside.sum(), points[outside][0]))
+        return points
+
+    def locate_cells(self, points):
+        """
+        Vectorized version of locate_cell for an array of points
+        with shape (npoints, nsd) (or (npoints,) in 1D).
+        Return the same four quantities as locate_cell, but as arrays
+        of shape (npoints, nsd): cell indices, distances, match (bool),
+        and nearest grid point indices, where row p holds the result
+        for point p.
+
+        >>> g2 = UniformBoxGrid.init_fromstring('[-1,1]x[-1,2] [0:3]x[0:4]')
+        >>> index, distance, match, nearest = \\
+        ...        g2.locate_cells([(0.2,0.2), (1,2)])
+        >>> print index
+        [[1 1]
+         [3 4]]
+        >>> print nearest
+        [[2 2]
+         [3 4]]
+        """
+        points = self._points_array(points)
+        index = ((points - self.min_coor)//self.delta).astype(int)
+        distance = points - (self.min_coor + index*self.delta)
+        nearest = index + (distance > self.delta/2)
+        match = abs(distance) < self.tolerance
+        nearest = where(match, index, nearest)
+        # last cell, update index such that it coincides with the point:
+        last = abs(distance - self.delta) < self.tolerance
+        index += last
+        distance[last] = 0.0
+        match |= last
+        nearest = where(last, index, nearest)
+        return index, distance, match, nearest
+
     def interpolate(v0, v1, x0, x1, x):
         return v0 + (v1-v0)/float(x1-x0)*(x-x0)
 
@@ -659,6 +896,128 @@ class UniformBoxGrid(object):
         plane_slice[constant_coor] = start_nearest[constant_coor]
         return tuple(plane_slice), not start_match[constant_coor]
 
+    def decompose(self, nparts, ghost=1):
+        """
+        Split the grid into overlapping subgrids for parallel computing.
+        nparts is the number of parts along the first axis, or a
+        sequence with the number of parts in each space direction.
+        Each part owns a box of grid points and has, in addition,
+        ghost layers of (up to) ghost points copied from the
+        neighboring parts.
+
+        Return a list with a tuple (subgrid, global_slices, owned_slices)
+        for each part, where subgrid is the grid over the owned and
+        ghost points, global_slices are the slices of these points in
+        an array over the whole grid, and owned_slices are the slices
+        of the owned points in an array over the subgrid.
+
+        >>> g = UniformBoxGrid(min=(0,0), max=(1,1), division=(8,4))
+        >>> for subgrid, global_slices, owned_slices in g.decompose(2):
+        ...     print subgrid.shape, global_slices[0], owned_slices[0]
+        ...
+        (5, 5) slice(0, 5, None) slice(0, 4, None)
+        (6, 5) slice(3, 9, None) slice(1, 6, None)
+        """
+        if isinstance(nparts, int):
+            nparts = [nparts] + [1]*(self.nsd-1)
+        if len(nparts) != self.nsd:
+            raise ValueError('nparts=%s must have %d elements' %
+                             (nparts, self.nsd))
+        # start and stop indices of the owned points in each direction:
+        ranges = []
+        for n, p in zip(self.shape, nparts):
+            if not 1 <= p <= n:
+                raise ValueError('cannot split %d points in %d parts' % (n, p))
+            bounds = [i*n//p for i in range(p+1)]
+            ranges.append(zip(bounds[:-1], bounds[1:]))
+
+        parts = []
+        for owned in itertools.product(*ranges):
+            lo = [max(0, start - ghost) for start, stop in owned]
+            hi = [min(n, stop + ghost)
+                  for (start, stop), n in zip(owned, self.shape)]
+            if min([h - l for l, h in zip(lo, hi)]) < 2:
+                raise ValueError('too many parts (%s) or too few ghost '
+                                 'points (%d): a part must have at least '
+                                 'two points in each direction' %
+                                 (nparts, ghost))
+            global_slices = tuple([slice(l, h) for l, h in zip(lo, hi)])
+            owned_slices = tuple([slice(start - l, stop - l)
+                                  for (start, stop), l in zip(owned, lo)])
+            parts.append((self._subgrid(global_slices),
+                          global_slices, owned_slices))
+        return parts
+
+    def coarsen(self):
+        """
+        Return grid with half as many cells in each direction
+        (every second grid point). All divisions must be even.
+
+        >>> g = UniformBoxGrid(min=(0,0), max=(1,2), division=(8,4))
+        >>> print g.coarsen()
+        domain=[0,1]x[0,2]  indices=[0:4]x[0:2]
+        """
+        if not self._coarsenable():
+            raise ValueError('cannot coarsen grid with division %s '
+                             '(must be even numbers)' % list(self.division))
+        return UniformBoxGrid(min=self.min_coor, max=self.max_coor,
+                              division=[d//2 for d in self.division],
+                              dirnames=self.dirnames)
+
+    def refine(self):
+        """Return grid with twice as many cells in each direction."""
+        return UniformBoxGrid(min=self.min_coor, max=self.max_coor,
+                              division=[2*d for d in self.division],
+                              dirnames=self.dirnames)
+
+    def _coarsenable(self):
+        return min([d % 2 == 0 and d >= 2 for d in self.division])
+
+    def hierarchy(self, nlevels=None):
+        """
+        Return list of grids [self, self.coarsen(), ...] (e.g., for
+        multigrid methods), with nlevels grids or, if nlevels is None,
+        as many grids as possible (until a division is odd).
+        """
+        grids = [self]
+        while (nlevels is None or len(grids) < nlevels) and \
+              grids[-1]._coarsenable():
+            grids.append(grids[-1].coarsen())
+        if nlevels is not None and len(grids) < nlevels:
+            raise ValueError('cannot make %d levels from grid with '
+                             'division %s' % (nlevels, list(self.division)))
+        return grids
+
+    def _subgrid(self, slices):
+        """Return grid over the points given by slices (for decompose)."""
+        coor = [c[s] for c, s in zip(self.coor, slices)]
+        return UniformBoxGrid(min=[c[0] for c in coor],
+                              max=[c[-1] for c in coor],
+                              division=[len(c)-1 for c in coor],
+                              dirnames=self.dirnames)
+
+
+
+def _eval_slab(f, grid, slab):
+    """Evaluate f for grid points slab[0]:slab[1] along the first axis."""
+    # (the coordinate arrays are made for the slab only, from grid.coor,
+    # such that the full grid.coorv arrays are never needed)
+    coorv = ndgrid(grid.coor[0][slice(*slab)], *grid.coor[1:])
+    if not isinstance(coorv, (list,tuple)):
+        coorv = [coorv]  # 1D grid
+    a = f(*coorv)
+    grid._check_vectorized(f, a, (slab[1]-slab[0],) + tuple(grid.shape[1:]))
+    return a
+
+def _fill_slab(f, grid, slab, values):
+    values[slice(*slab)] = _eval_slab(f, grid, slab)
+
+# (f, grid, values) in UniformBoxGrid.vectorized_eval with processes:
+_eval_state = None
+
+def _fill_slab_from_state(slab):
+    f, grid, values = _eval_state
+    _fill_slab(f, grid, slab, values)
 
 
 class BoxGrid(UniformBoxGrid):
@@ -672,21 +1031,88 @@ class BoxGrid(UniformBoxGrid):
     grid coordinates in that space direction (stored as an array).
     """
     def __init__(self, coor, dirnames=('x', 'y', 'z')):
-
+        # (the given coordinates replace the uniform ones in _make_coor,
+        # such that _more_init runs only once, for the right coordinates)
+        self._given_coor = [asarray(a, float) for a in coor]
         UniformBoxGrid.__init__(self,
                                 min=[a[0] for a in coor],
                                 max=[a[-1] for a in coor],
                                 division=[len(a)-1 for a in coor],
                                 dirnames=dirnames)
-        # override:
-        self.coor = coor
+        del self._given_coor
+
+    def _make_coor(self):
+        return self._given_coor
 
     def __repr__(self):
         s = self.__class__.__name__ + '(coor=%s)' % self.coor
         return s
 
+    def coarsen(self):
+        """Return grid with every second grid point in each direction."""
+        if not self._coarsenable():
+            raise ValueError('cannot coarsen grid with division %s '
+                             '(must be even numbers)' % list(self.division))
+        return BoxGrid([c[::2] for c in self.coor], dirnames=self.dirnames)
+
+    def refine(self):
+        """Return grid with the midpoints of the cells added."""
+        coor = []
+        for c in self.coor:
+            fine = empty(2*len(c)-1)
+            fine[::2] = c
+            fine[1::2] = 0.5*(c[:-1] + c[1:])
+            coor.append(fine)
+        return BoxGrid(coor, dirnames=self.dirnames)
+
+    def _subgrid(self, slices):
+        return BoxGrid([c[s] for c, s in zip(self.coor, slices)],
+                       dirnames=self.dirnames)
+
     def locate_cell(self, point):
-        raise NotImplementedError('Cannot locate point in cells in non-uniform grids')
+        """
+        As UniformBoxGrid.locate_cell, but for non-uniform grids
+        (the cell is found by binary search in the coordinates).
+        """
+        if isinstance(point, (int,float)):
+            point = [point]
+        if len(point) != self.nsd:
+            raise ValueError('point=%s has wrong dimension (this is a %dD grid!)' % \
+                             (point, self.nsd))
+        index, distance, match, nearest = self.locate_cells([point])
+        return index[0].tolist(), distance[0], match[0].tolist(), \
+               nearest[0].tolist()
+
+    def locate_cells(self, points):
+        """
+        As UniformBoxGrid.locate_cells, but for non-uniform grids
+        (the cells are found by binary search in the coordinates).
+
+        >>> g = BoxGrid([array([0, 0.1, 0.3, 1]), array([-1, 0, 1])])
+        >>> index, distance, match, nearest = g.locate_cells([(0.25,0.5)])
+        >>> print index, nearest
+        [[1 1]] [[2 1]]
+        """
+        points = self._points_array(points)
+        index = empty(points.shape, int)
+        distance = empty(points.shape)
+        delta = empty(points.shape)  # local cell size
+        for i in range(self.nsd):
+            coor = self.coor[i]
+            index[:,i] = searchsorted(coor, points[:,i], 'right') - 1
+            index[:,i] = index[:,i].clip(0, len(coor)-2)
+            distance[:,i] = points[:,i] - coor[index[:,i]]
+            delta[:,i] = coor[index[:,i]+1] - coor[index[:,i]]
+        nearest = index + (distance > delta/2)
+        match = abs(distance) < self.tolerance
+        nearest = where(match, index, nearest)
+        # last cell, update index such that it coincides with the point:
+        last = abs(distance - delta) < self.tolerance
+        index += last
+        distance[last] = 0.0
+        match |= last
+        nearest = where(last, index, nearest)
+        return index, distance, match, nearest
 
 
 def _test(g, points=None):
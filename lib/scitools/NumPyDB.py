@@ -3,72 +3,519 @@
 Efficient database for NumPy objects.
 """
 
-import sys, os, pickle, re
+import sys, os, pickle, re, bisect, threading, collections, struct
+import itertools
+import array as arraymodule
 from scitools.numpytools import *
+import numpy
+
+# typecode for arrays of file positions ('q' is not available in
+# Python 2, and 'l' is 32 bits on some platforms):
+for _offset_typecode in 'q', 'l', 'd':
+    try:
+        if arraymodule.array(_offset_typecode).itemsize == 8:
+            break
+    except ValueError:
+        pass
 
 class NumPyDB:
     def __init__(self, database_name, mode='store'):
         self.filename = database_name
         self.dn = self.filename + '.dat' # NumPy array data
         self.pn = self.filename + '.map' # positions & identifiers
+        self._fd = self._fm = None  # open files in writer mode (see open)
+        self._async = None  # _AsyncDumper thread in async mode
+        self.ix = self.filename + '.idx' # binary copy of the map file
         if mode == 'store':
             # bring files into existence:
             fd = open(self.dn, 'w');  fd.close()
             fm = open(self.pn, 'w');  fm.close()
+            if os.path.isfile(self.ix):
+                os.remove(self.ix)
         elif mode == 'load':
             # check if files are there:
             if not os.path.isfile(self.dn) or \
                not os.path.isfile(self.pn):
                 raise IOError("Could not find the files %s and %s" %\
                               (self.dn, self.pn))
-            # load mapfile into list of tuples:
+        # the map file is not read before its contents are needed
+        # (see __getattr__)
+
+    # The contents of the map file are stored in
+    # self._offsets: array of positions in the .dat file (64-bit ints),
+    # self._identifiers: list of the corresponding identifiers,
+    # self._codecs: dict with the codec of compressed records (pos -> codec).
+    # The following attributes are computed on demand from these:
+    # self.positions: list of (position, identifier) tuples,
+    # self._index: dict for exact lookup of identifiers (identifier -> pos),
+    # self._sorted_index: dict of _SortedIdentifiers objects for
+    # bestapprox and load_range lookup (key function -> object).
+
+    def __getattr__(self, name):
+        # (only called when name is not a set attribute)
+        if name in ('_offsets', '_identifiers', '_codecs'):
+            self._read_map()
+        elif name == 'positions':
+            self.positions = zip(self._offsets, self._identifiers)
+        elif name == '_index':
+            # the first record with a given identifier is the one found,
+            # i.e., the last one to be inserted in reversed order
+            self._index = dict(itertools.izip(reversed(self._identifiers),
+                                              reversed(self._offsets)))
+        elif name == '_sorted_index':
+            self._sorted_index = {}
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    # a binary index file (.idx) is written when a map file with at
+    # least index_file_threshold records is read:
+    index_file_threshold = 10000
+    _index_header = struct.Struct('<8scqdqqq')
+    _index_magic = 'NPDBIDX1'
+
+    def _forget_map(self):
+        """Drop the map data such that they are read again when needed."""
+        for name in ('_offsets', '_identifiers', '_codecs', 'positions',
+                     '_index', '_sorted_index'):
+            self.__dict__.pop(name, None)
+
+    def _read_map(self, lock=True):
+        """
+        Load mapfile (or the binary index file if it is up to date).
+        lock=False means that the caller has already locked the file.
+        """
+        for name in 'positions', '_index', '_sorted_index':
+            self.__dict__.pop(name, None)  # must be recomputed
+        while True:
             fm = open(self.pn, 'r')
+            if not lock:
+                break
+            # a writer holds an exclusive lock while appending lines
+            _lock(fm, exclusive=False)
+            if os.fstat(fm.fileno()).st_ino == os.stat(self.pn).st_ino:
+                break
+            # compact replaced the map file while we waited for the
+            # lock, the old file has offsets into the old .dat file
+            _unlock(fm)
+            fm.close()
+        try:
+            stat = os.fstat(fm.fileno())
+            if self._read_index_file(stat.st_size, stat.st_mtime):
+                return
             lines = fm.readlines()
-            self.positions = []
-            for line in lines:
-                # first column contains file positions in the
-                # file .dat for direct access, the rest of the
-                # line is an identifier
-                c = line.split()
-                # append tuple (position, identifier):
-                self.positions.append((int(c[0]),
-                                       ' '.join(c[1:]).strip()))
+        finally:
+            if lock:
+                _unlock(fm)
             fm.close()
+        if lines and not lines[-1].endswith('\n'):
+            # half-written line from a writer that does not lock the file
+            del lines[-1]
+        self._offsets = arraymodule.array(_offset_typecode)
+        self._identifiers = []
+        self._codecs = {}  # position -> compression codec
+        for line in lines:
+            # first column contains file positions in the
+            # file .dat for direct access (possibly followed by
+            # :codec for compressed records), the rest of the
+            # line is an identifier
+            c = line.split()
+            pos = c[0].split(':')
+            if len(pos) > 1:
+                self._codecs[int(pos[0])] = pos[1]
+            self._offsets.append(int(pos[0]))
+            self._identifiers.append(' '.join(c[1:]).strip())
+        if len(lines) >= self.index_file_threshold and \
+           sum(map(len, lines)) == stat.st_size:  # (no half-written line)
+            self._write_index_file(stat.st_size, stat.st_mtime)
+
+    def _write_index_file(self, map_size, map_mtime):
+        """
+        Store the contents of the map file in binary form in the .idx
+        file, such that the map file need not be parsed next time.
+        """
+        offsets = arraymodule.array(_offset_typecode, self._offsets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        codecs = '\n'.join(['%d:%s' % item for item in self._codecs.items()])
+        identifiers = '\n'.join(self._identifiers)
+        tmp = self.ix + '.%d' % os.getpid()
+        try:
+            f = open(tmp, 'wb')
+            f.write(self._index_header.pack(
+                self._index_magic, _offset_typecode,
+                map_size, map_mtime, len(offsets),
+                len(codecs), len(identifiers)))
+            f.write(offsets.tostring())
+            f.write(codecs)
+            f.write(identifiers)
+            f.close()
+            _replace(tmp, self.ix)
+        except (IOError, OSError):
+            pass  # e.g. no write permission, just parse the map next time
+
+    def _read_index_file(self, map_size, map_mtime):
+        """
+        Load the contents of the .idx file if it corresponds to a map
+        file with the given size and modification time.
+        Return True if the index file was loaded.
+        """
+        try:
+            f = open(self.ix, 'rb')
+        except IOError:
+            return False
+        try:
+            header = f.read(self._index_header.size)
+            if len(header) != self._index_header.size:
+                return False
+            magic, typecode, size, mtime, n, codecs_len, identifiers_len = \
+                   self._index_header.unpack(header)
+            if magic != self._index_magic or typecode != _offset_typecode \
+               or size != map_size or mtime != map_mtime:
+                return False  # index file is outdated
+            offsets = arraymodule.array(_offset_typecode)
+            offsets.fromstring(f.read(offsets.itemsize*n))
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            codecs = f.read(codecs_len)
+            identifiers = f.read(identifiers_len)
+        finally:
+            f.close()
+        self._offsets = offsets
+        self._codecs = {}
+        if codecs:
+            for item in codecs.split('\n'):
+                pos, codec = item.split(':')
+                self._codecs[int(pos)] = codec
+        self._identifiers = identifiers.split('\n') if n > 0 else []
+        return True
 
     def locate(self, identifier, bestapprox=None): # base class
         """
         Find position in files where data corresponding
         to identifier are stored.
         bestapprox is a user-defined function for computing
-        the distance between two identifiers.
+        the distance between two identifiers. If bestapprox has
+        a key attribute (see float_dist), the nearest identifier
+        is found by bisection in a sorted index instead of
+        computing the distance to every stored identifier.
         """
         identifier = identifier.strip()
         # first search for an exact identifier match:
-        selected_pos = -1
+        selected_pos = self._index.get(identifier, -1)
         selected_id = None
-        for pos, id in self.positions:
-            if id == identifier:
-                selected_pos = pos;  selected_id = id; break
-        if selected_pos == -1: # 'identifier' not found?
-            if bestapprox is not None:
-                # find the best approximation to 'identifier':
-                min_dist = \
-                    bestapprox(self.positions[0][1], identifier)
-                for pos, id in self.positions:
-                    d = bestapprox(id, identifier)
-                    if d <= min_dist:
-                        selected_pos = pos;  selected_id = id
-                        min_dist = d
+        if selected_pos != -1:
+            selected_id = identifier
+        elif bestapprox is not None and self._identifiers:
+            # find the best approximation to 'identifier':
+            j = _nearest(self._sorted_index, bestapprox,
+                         self._identifiers, identifier)
+            selected_pos = self._offsets[j]
+            selected_id = self._identifiers[j]
         return selected_pos, selected_id
 
-    def dump(self, a, identifier):  # empty base class func.
-        """Dump NumPy array a with identifier."""
+    _write_mode = 'a'  # mode for opening the .dat file in dump
+
+    def dump(self, a, identifier):
+        """
+        Dump NumPy array a with identifier.
+        In async mode (see start_async) the array is queued and
+        written by a background thread.
+        """
+        if self._async is not None:
+            if self._async_copy:
+                a = numpy.array(a)
+            elif isinstance(a, numpy.ndarray):
+                # queue a read-only reference to the caller's data
+                a = a.view()
+                a.flags.writeable = False
+            self._async.put(a, identifier)
+        else:
+            self._dump_now(a, identifier)
+
+    def _dump_now(self, a, identifier):
+        if self._fd is None:
+            # not in writer mode, open and close the files for each dump:
+            fd = open(self.dn, self._write_mode)
+            fd.seek(0, 2)  # make sure tell() returns the end of the file
+            line = self._dump(fd, a, identifier)
+            fd.close()
+            # the data are written before the map line pointing to them
+            fm = open(self.pn, 'a')
+            _lock(fm, exclusive=True)
+            fm.write(line)
+            fm.close()  # (flushes and releases the lock)
+            self._forget_map()
+        else:
+            # the map lines are written in _flush_files
+            self._map_lines.append(self._dump(self._fd, a, identifier))
+            self._ndumps += 1
+            if self._fsync_interval and \
+                   self._ndumps % self._fsync_interval == 0:
+                self._flush_files(fsync=True)
+            elif self._flush_interval and \
+                   self._ndumps % self._flush_interval == 0:
+                self._flush_files()
+
+    def _dump(self, fd, a, identifier):
+        """
+        Write a record to the open .dat file fd and return the
+        corresponding line in the .map file.
+        """
+        pos = self._record_start(fd)
+        self._dump_record(fd, a)
+        return self._map_line(pos, identifier)
+
+    def _map_line(self, pos, identifier, codec=None):
+        if codec is None:
+            return "%d\t\t %s\n" % (pos, identifier)
+        else:
+            return "%d:%s\t\t %s\n" % (pos, codec, identifier)
+
+    def _record_start(self, fd):
+        """Return the position of a new record in the .dat file."""
+        return fd.tell()
+
+    def _dump_record(self, fd, a):  # empty base class func.
+        """Write NumPy array a at the current position in fd."""
         raise NameError("dump is not implemented; must be impl. in subclass")
 
+    def open(self, buffering=-1, flush_interval=0, fsync_interval=0):
+        """
+        Enter writer mode: keep the .dat and .map files open for
+        subsequent dump calls until close is called.
+        buffering is the buffer size in bytes of the files, as in the
+        built-in open (-1: system default, 0: unbuffered).
+        The buffers are flushed every flush_interval dump call
+        and also synchronized with the disk (os.fsync) every
+        fsync_interval dump call (0 means never, except in
+        flush and close). Return self such that the database
+        can be used in a with statement::
+
+            db = NumPyDB_cPickle('mydata', 'store')
+            with db.open(buffering=2**20, flush_interval=100):
+                for i in range(n):
+                    ...
+                    db.dump(u, 'time=%g' % t)
+        """
+        if self._fd is not None:
+            raise IOError('%s is already open for writing' % self.filename)
+        self._fd = open(self.dn, self._write_mode, buffering)
+        self._fd.seek(0, 2)
+        self._fm = open(self.pn, 'a', buffering)
+        self._map_lines = []  # map lines not yet written
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._ndumps = 0
+        return self
+
+    def flush(self, fsync=False):
+        """
+        Flush the buffers of the files in writer mode (and call
+        os.fsync if fsync is true). In async mode, first wait
+        until all queued arrays are written.
+        """
+        if self._async is not None:
+            self._async.wait()
+        self._flush_files(fsync)
+
+    def _flush_files(self, fsync=False):
+        if self._fd is None:
+            return
+        # the data must reach the file before the map lines pointing
+        # to them, and readers must not see half-written map lines
+        self._fd.flush()
+        if fsync:
+            os.fsync(self._fd.fileno())
+        _lock(self._fm, exclusive=True)
+        try:
+            self._fm.write(''.join(self._map_lines))
+            self._map_lines = []
+            self._fm.flush()
+            if fsync:
+                os.fsync(self._fm.fileno())
+        finally:
+            _unlock(self._fm)
+        self._forget_map()
+
+    def close(self):
+        """
+        Leave writer mode (and async mode) and close the files.
+        An error in the background thread of async mode is raised
+        after the files are closed (the map lines of the arrays that
+        were written are stored).
+        """
+        try:
+            self.stop_async()
+        finally:
+            if self._fd is not None:
+                try:
+                    self._flush_files(fsync=self._fsync_interval > 0)
+                finally:
+                    self._fd.close();  self._fm.close()
+                    self._fd = self._fm = None
+
+    def start_async(self, max_queued_bytes=2**28, copy=True, **kwargs):
+        """
+        Enter async mode: dump puts the array in a queue and returns
+        immediately, while a background thread writes the queued
+        arrays to file. The files are kept open as in writer mode
+        (kwargs are passed on to open if the database is not
+        already open).
+
+        If copy is true, dump queues a copy of the array, otherwise
+        a read-only view of the array is queued. The view only
+        protects the queued reference: nothing prevents the caller
+        from changing the array itself, which must not be done before
+        the array is written (after flush).
+        When the queued arrays occupy more than max_queued_bytes
+        bytes, dump blocks until the background thread has written
+        enough data.
+
+        Call flush to wait for all queued arrays to be written, and
+        stop_async or close to leave async mode. Errors in the
+        background thread are raised in the next dump, flush,
+        or stop_async call.
+        """
+        if self._async is not None:
+            raise IOError('%s is already in async mode' % self.filename)
+        if self._fd is None:
+            self.open(**kwargs)
+        self._async_copy = copy
+        self._async = _AsyncDumper(self._dump_now, max_queued_bytes)
+        self._async.start()
+        return self
+
+    def stop_async(self):
+        """Write all queued arrays and leave async mode."""
+        if self._async is not None:
+            dumper = self._async
+            self._async = None
+            dumper.stop()
+
+    def __enter__(self):
+        if self._fd is None:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def load(self, identifier, bestapprox=None):
         """Load NumPy array with identifier or find best approx."""
         raise NameError("load is not implemented; must be impl. in subclass")
 
+    def compact(self, key=None):
+        """
+        Rewrite the database files such that records which can never
+        be loaded (because an earlier record has the same identifier)
+        are dropped, and the remaining records are stored in sorted
+        order of the identifiers. With key=None, identifiers are
+        sorted as numbers if all of them can be converted by float,
+        and as strings otherwise. Otherwise, key is a function
+        turning an identifier into a sort key (see load_range).
+        Sequential reads (load_range, load_many) then read
+        contiguous parts of the .dat file.
+
+        The map file is locked during the compaction, and processes
+        that read the map file wait for the new one. Processes that
+        have already read the map file (for loading) or have the
+        database open in writer mode must reopen it afterwards.
+        Plain dump calls (outside writer mode) in other processes
+        must not run during a compaction either: they append to the
+        .dat file before locking the map file, so their record can
+        be lost.
+        """
+        if self._fd is not None or self._async is not None:
+            raise IOError('close the database %s before compacting' %
+                          self.filename)
+        fm = open(self.pn, 'r+')
+        _lock(fm, exclusive=True)
+        try:
+            self._read_map(lock=False)
+            # the records found by locate:
+            records = [(id, pos) for pos, id in
+                       zip(self._offsets, self._identifiers)
+                       if self._index[id] == pos]
+            if key is None:
+                try:
+                    records = [(float(id), pos, id) for id, pos in records]
+                except ValueError:
+                    records = [(id, pos, id) for id, pos in records]
+            else:
+                records = [(key(id), pos, id) for id, pos in records]
+            records.sort()
+
+            # length of each record = distance to the next position:
+            filesize = os.path.getsize(self.dn)
+            positions = sorted(set(self._offsets))
+            ends = dict(zip(positions, positions[1:] + [filesize]))
+
+            tmp_dn = self.dn + '.compact';  tmp_pn = self.pn + '.compact'
+            fd_in = open(self.dn, 'rb')
+            fd_out = open(tmp_dn, 'wb')
+            lines = []
+            for k, pos, id in records:
+                new_pos = self._record_start(fd_out)
+                fd_in.seek(pos)
+                _copy_bytes(fd_in, fd_out, ends[pos] - pos)
+                lines.append(self._map_line(new_pos, id,
+                                            self._codecs.get(pos)))
+            fd_in.close();  fd_out.close()
+            fm_out = open(tmp_pn, 'w')
+            fm_out.write(''.join(lines))
+            fm_out.close()
+            # (an index file could match the new map file by size and
+            # modification time)
+            if os.path.isfile(self.ix):
+                os.remove(self.ix)
+            _replace(tmp_dn, self.dn)
+            _replace(tmp_pn, self.pn)
+        finally:
+            _unlock(fm)
+            fm.close()
+        self._read_map()
+
+    _read_mode = 'r'  # mode for opening the .dat file in load methods
+
+    def _load_record(self, fd, pos):
+        """Load the array stored at position pos in the open .dat file."""
+        raise NameError("_load_record is not implemented; must be impl. in subclass")
+
+    def load_many(self, identifiers, bestapprox=None):
+        """
+        Load the NumPy arrays with the given identifiers (a list).
+        Return a list of (array, identifier) pairs, where each pair
+        is as returned from load (with None as array and "not found"
+        as identifier if an identifier is not found).
+
+        All positions are looked up first, and the arrays are then
+        read in one pass through the .dat file, in the order they
+        are stored, using a single open file.
+        """
+        located = [self.locate(identifier, bestapprox)
+                   for identifier in identifiers]
+        arrays = {}  # pos -> array
+        fd = open(self.dn, self._read_mode)
+        for pos in sorted(set([pos for pos, id in located if pos >= 0])):
+            arrays[pos] = self._load_record(fd, pos)
+        fd.close()
+        return [(arrays[pos], id) if pos >= 0 else (None, "not found")
+                for pos, id in located]
+
+    def load_range(self, t0, t1, key=float):
+        """
+        Load all NumPy arrays with identifiers id such that
+        t0 <= key(id) <= t1. The key function must turn an
+        identifier into a number, e.g., key=float if the identifiers
+        are time values, or key=lambda id: float(id[5:]) for
+        identifiers of the form 'time=4.000000e+00'.
+        Identifiers that key cannot turn into a number are skipped.
+        Return a list of (array, identifier) pairs sorted on key.
+        """
+        return self.load_many(_in_range(self._sorted_index,
+                                        self._identifiers, t0, t1, key))
+
 
 class NumPyDB_text(NumPyDB):
     """Use plain ASCII string representation."""
@@ -77,21 +524,13 @@ class NumPyDB_text(NumPyDB):
         NumPyDB.__init__(self, database_name, mode)
 
     # simple dump:
-    def dump(self, a, identifier):
-        """Dump NumPy array a with identifier."""
-        fd = open(self.dn, 'a');  fm = open(self.pn, 'a')
-        fm.write("%d\t\t %s\n" % (fd.tell(), identifier))
+    def _dump_record(self, fd, a):
         fd.write(repr(a))
-        fd.close();  fm.close()
 
     # more efficient dump (due to Mario Pernici <Mario.Pernici@mi.infn.it>)
-    def dump(self, a, identifier):
-        """Dump NumPy array a with identifier."""
-        fd = open(self.dn, 'a');  fm = open(self.pn, 'a')
-        fm.write("%d\t\t %s\n" % (fd.tell(), identifier))
+    def _dump_record(self, fd, a):
         fmt = 'array([' + '%s,'*(a.size-1) + '%s])\n'
         fd.write(fmt % tuple(ravel(a)))
-        fd.close();  fm.close()
 
 
     def load(self, identifier, bestapprox=None):
@@ -105,24 +544,23 @@ class NumPyDB_text(NumPyDB):
         pos, id = self.locate(identifier, bestapprox)
         if pos < 0: return [None, "not found"]
         fd = open(self.dn, 'r')
-        fd.seek(pos)
-        # load the correct number of bytes; look at the next pos
-        # value in self.positions (impossible if a dictionary is
-        # used for self.positions - we need the order of the items!)
-        for j in range(len(self.positions)):
-            p = self.positions[j][0]
-            if p == pos:
-                try:
-                    s = fd.read(self.positions[j+1][0] - p)
-                except IndexError:
-                    # last self.positions entry reached,
-                    # just read the rest of the file:
-                    s = fd.read()
-                break
-        a = eval(s)
+        a = self._load_record(fd, pos)
         fd.close()
         return [a, id]
 
+    def _load_record(self, fd, pos):
+        fd.seek(pos)
+        # load the correct number of bytes; look at the next pos
+        # value in self._offsets (sorted since records are appended)
+        j = bisect.bisect_left(self._offsets, pos)
+        try:
+            s = fd.read(self._offsets[j+1] - pos)
+        except IndexError:
+            # last self._offsets entry reached,
+            # just read the rest of the file:
+            s = fd.read()
+        return eval(s)
+
 
 class NumPyDB_pickle (NumPyDB):
     """Use basic Pickle class."""
@@ -130,12 +568,8 @@ class NumPyDB_pickle (NumPyDB):
     def __init__(self, database_name, mode='store'):
         NumPyDB.__init__(self,database_name, mode)
 
-    def dump(self, a, identifier):
-        """Dump NumPy array a with identifier."""
-        fd = open(self.dn, 'a');  fm = open(self.pn, 'a')
-        fm.write("%d\t\t %s\n" % (fd.tell(), identifier))
+    def _dump_record(self, fd, a):
         pickle.dump(a, fd, 1)  # 1: binary storage
-        fd.close();  fm.close()
 
     def load(self, identifier, bestapprox=None):
         """
@@ -148,11 +582,14 @@ class NumPyDB_pickle (NumPyDB):
         pos, id = self.locate(identifier, bestapprox)
         if pos < 0: return None, "not found"
         fd = open(self.dn, 'r')
-        fd.seek(pos)
-        a = pickle.load(fd)
+        a = self._load_record(fd, pos)
         fd.close()
         return a, id
 
+    def _load_record(self, fd, pos):
+        fd.seek(pos)
+        return pickle.load(fd)
+
 import cPickle
 
 class NumPyDB_cPickle (NumPyDB):
@@ -161,14 +598,8 @@ class NumPyDB_cPickle (NumPyDB):
     def __init__(self, database_name, mode='store'):
         NumPyDB.__init__(self,database_name, mode)
 
-    def dump(self, a, identifier):
-        """Dump NumPy array a with identifier."""
-        # fd: datafile, fm: mapfile
-        fd = open(self.dn, 'a');  fm = open(self.pn, 'a')
-        # fd.tell(): return current position in datafile
-        fm.write("%d\t\t %s\n" % (fd.tell(), identifier))
+    def _dump_record(self, fd, a):
         cPickle.dump(a, fd, 1)  # 1: binary storage
-        fd.close();  fm.close()
 
     def load(self, identifier, bestapprox=None):
         """
@@ -181,11 +612,192 @@ class NumPyDB_cPickle (NumPyDB):
         pos, id = self.locate(identifier, bestapprox)
         if pos < 0: return [None, "not found"]
         fd = open(self.dn, 'r')
-        fd.seek(pos)
-        a = cPickle.load(fd)
+        a = self._load_record(fd, pos)
         fd.close()
         return [a, id]
 
+    def _load_record(self, fd, pos):
+        fd.seek(pos)
+        return cPickle.load(fd)
+
+
+import zlib, bz2
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# compressor and decompressor constructors for NumPyDB_mmap records:
+_codecs = {
+    'zlib': (lambda level: zlib.compressobj(level), zlib.decompressobj),
+    'bz2': (lambda level: bz2.BZ2Compressor(level), bz2.BZ2Decompressor),
+    }
+if lzma is not None:
+    _codecs['lzma'] = (lambda level: lzma.LZMACompressor(preset=level),
+                       lzma.LZMADecompressor)
+
+class NumPyDB_mmap (NumPyDB):
+    """
+    Store arrays in raw binary form and load them as numpy.memmap views.
+
+    Each record in the .dat file consists of a small header with the
+    dtype and shape of the array, followed by the contiguous array data
+    (C order). Records and array data start on 16-byte boundaries so
+    the memory-mapped arrays are properly aligned.
+    Loading a record does not read the data: load returns a numpy.memmap
+    view into the .dat file and the operating system pages in the
+    parts of the array that are actually accessed.
+
+    Optionally, the array data can be compressed (codec='zlib', 'bz2',
+    or 'lzma' if the lzma module is available). The codec of each
+    record is stored in the .map file, so compressed and uncompressed
+    records can be mixed in a database. Compressed records are loaded
+    into ordinary arrays by streaming the decompressed data directly
+    into the array.
+    """
+    # header: magic, length of dtype string, no of dimensions
+    # (followed by the dtype string and the shape as 64-bit ints)
+    _header = struct.Struct('<4sHH')
+    _magic = 'NPDB'
+    _alignment = 16
+
+    _chunk_size = 2**20  # bytes per compress/decompress step
+
+    def __init__(self, database_name, mode='store', mmap_mode='r',
+                 codec=None, compresslevel=6):
+        """
+        mmap_mode is the mode of the numpy.memmap arrays returned
+        from load: 'r' (read-only, default), 'r+' (changes are written
+        back to the database), or 'c' (copy-on-write, changes are
+        kept in memory only).
+        codec is the compression method for dumped arrays
+        (None, 'zlib', 'bz2', 'lzma') and compresslevel is the
+        compression level (1-9).
+        """
+        if codec is not None and codec not in _codecs:
+            raise ValueError('codec=%s is not available, choose among %s' %
+                             (codec, ', '.join(sorted(_codecs.keys()))))
+        NumPyDB.__init__(self, database_name, mode)
+        self.mmap_mode = mmap_mode
+        self.codec = codec
+        self.compresslevel = compresslevel
+        # the file object must allow writing for 'r+' memmaps:
+        self._read_mode = 'r+b' if mmap_mode == 'r+' else 'rb'
+
+    def _pad(self, fd):
+        """Write zero bytes to fd until the position is aligned."""
+        npad = -fd.tell() % self._alignment
+        if npad:
+            fd.write('\0'*npad)
+
+    _write_mode = 'ab'
+
+    def dump(self, a, identifier):
+        """Dump NumPy array a with identifier."""
+        a = numpy.asarray(a)
+        if a.dtype.hasobject:
+            raise TypeError('cannot store arrays of Python objects in %s' %
+                            self.__class__.__name__)
+        NumPyDB.dump(self, a, identifier)
+
+    def _record_start(self, fd):
+        self._pad(fd)
+        return fd.tell()
+
+    def _dump(self, fd, a, identifier):
+        pos = self._record_start(fd)
+        codec = self.codec  # (may be changed by the user between dumps)
+        self._dump_record(fd, a, codec)
+        return self._map_line(pos, identifier, codec)
+
+    def _dump_record(self, fd, a, codec=None):
+        dtype_str = a.dtype.str
+        fd.write(self._header.pack(self._magic, len(dtype_str), a.ndim))
+        fd.write(dtype_str)
+        fd.write(struct.pack('<%dq' % a.ndim, *a.shape))
+        self._pad(fd)
+        if codec is None:
+            a.tofile(fd)  # C order, also for non-contiguous arrays
+        else:
+            # compress chunks of the flat array to avoid a compressed
+            # copy of the whole array in memory:
+            compressor = _codecs[codec][0](self.compresslevel)
+            a = a.ravel()  # (a copy only if a is non-contiguous)
+            n = max(1, self._chunk_size//max(1, a.itemsize))
+            for i in xrange(0, a.size, n):
+                fd.write(compressor.compress(a[i:i+n].tostring()))
+            fd.write(compressor.flush())
+
+    def _read_header(self, fd, pos):
+        """
+        Read the record header at position pos in the open file fd.
+        Return dtype, shape, and the position of the array data.
+        """
+        fd.seek(pos)
+        magic, dtype_len, ndim = \
+               self._header.unpack(fd.read(self._header.size))
+        if magic != self._magic:
+            raise IOError('corrupt record at position %d in %s' %
+                          (pos, self.dn))
+        dtype = numpy.dtype(fd.read(dtype_len))
+        shape = struct.unpack('<%dq' % ndim, fd.read(8*ndim))
+        data_pos = fd.tell()
+        data_pos += -data_pos % self._alignment
+        return dtype, shape, data_pos
+
+    def _load_record(self, fd, pos):
+        """
+        Return a numpy.memmap view of the array at position pos
+        (or an ordinary array if the record is compressed).
+        """
+        dtype, shape, data_pos = self._read_header(fd, pos)
+        codec = self._codecs.get(pos)
+        if codec is not None:
+            return self._decompress(fd, data_pos, dtype, shape, codec)
+        if numpy.prod(shape) == 0:
+            # mmap cannot map empty regions
+            return numpy.zeros(shape, dtype)
+        return numpy.memmap(fd, dtype=dtype, mode=self.mmap_mode,
+                            offset=data_pos, shape=shape)
+
+    def _decompress(self, fd, data_pos, dtype, shape, codec):
+        """Decompress a record chunk by chunk into a new array."""
+        if codec not in _codecs:
+            raise IOError('record in %s is compressed with %s, which is '
+                          'not available' % (self.dn, codec))
+        a = numpy.empty(shape, dtype)
+        buf = a.reshape(-1).view(numpy.uint8)  # the bytes of a
+        decompressor = _codecs[codec][1]()
+        fd.seek(data_pos)
+        filled = 0
+        while filled < buf.size:
+            chunk = fd.read(self._chunk_size)
+            if not chunk:
+                raise IOError('truncated record at position %d in %s' %
+                              (data_pos, self.dn))
+            data = decompressor.decompress(chunk)
+            n = min(len(data), buf.size - filled)
+            buf[filled:filled+n] = numpy.frombuffer(data, numpy.uint8, n)
+            filled += n
+        return a
+
+    def load(self, identifier, bestapprox=None):
+        """
+        Load NumPy array with a given identifier. In case the
+        identifier is not found, bestapprox != None means that
+        an approximation is sought. The bestapprox argument is
+        then taken as a function that can be used for computing
+        the distance between two identifiers id1 and id2.
+        The returned array is a numpy.memmap view of the data file
+        (unless the record is compressed).
+        """
+        pos, id = self.locate(identifier, bestapprox)
+        if pos < 0: return None, "not found"
+        fd = open(self.dn, self._read_mode)
+        a = self._load_record(fd, pos)
+        fd.close()
+        return a, id
+
 
 import shelve
 
@@ -194,35 +806,73 @@ class NumPyDB_shelve:
 
     def __init__(self, database_name, mode='store'):
         self.filename = database_name # no suffix, only one file
+        self._shelf = None  # open shelf in writer mode (see open)
         if mode == 'load':
             # since the keys() function in a shelf object
             # is slow, we store the keys:
             fd = shelve.open(self.filename)
             self.keys = list(fd.keys())
             fd.close()
+            self._index = set(self.keys)
+            self._sorted_index = {}
 
     def dump(self, a, identifier):
         """Dump NumPy array a with identifier."""
         identifier = identifier.strip()
-        fd = shelve.open(self.filename)
-        fd[identifier] = a
-        fd.close()
+        if self._shelf is None:
+            fd = shelve.open(self.filename)
+            fd[identifier] = a
+            fd.close()
+        else:
+            self._shelf[identifier] = a
+            self._ndumps += 1
+            if self._flush_interval and \
+                   self._ndumps % self._flush_interval == 0:
+                self.flush()
+
+    def open(self, flush_interval=0):
+        """
+        Enter writer mode: keep the shelf open for subsequent dump
+        calls until close is called. The shelf is synchronized
+        with the disk every flush_interval dump call (0 means never,
+        except in flush and close). See NumPyDB.open.
+        """
+        if self._shelf is not None:
+            raise IOError('%s is already open for writing' % self.filename)
+        self._shelf = shelve.open(self.filename)
+        self._flush_interval = flush_interval
+        self._ndumps = 0
+        return self
+
+    def flush(self):
+        """Synchronize the shelf in writer mode with the disk."""
+        if self._shelf is not None:
+            self._shelf.sync()
+
+    def close(self):
+        """Leave writer mode and close the shelf."""
+        if self._shelf is not None:
+            self._shelf.close()
+            self._shelf = None
+
+    def __enter__(self):
+        if self._shelf is None:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def locate(self, identifier, bestapprox=None):
         """Return identifier key in shelf."""
         selected_id = None
         identifier = identifier.strip()
-        if identifier in self.keys:
+        if identifier in self._index:
             selected_id = identifier
-        else:
-            if bestapprox:
-                # find the best approximation to 'identifier':
-                min_dist = bestapprox(self.keys[0], identifier)
-                for id in self.keys:
-                    d = bestapprox(id, identifier)
-                    if d <= min_dist:
-                        selected_id = id
-                        min_dist = d
+        elif bestapprox and self.keys:
+            # find the best approximation to 'identifier':
+            selected_id = self.keys[_nearest(self._sorted_index, bestapprox,
+                                             self.keys, identifier)]
         return selected_id
 
     def load(self, identifier, bestapprox=None):
@@ -240,6 +890,256 @@ class NumPyDB_shelve:
         fd.close()
         return a, id
 
+    def load_many(self, identifiers, bestapprox=None):
+        """
+        Load the NumPy arrays with the given identifiers (a list),
+        opening the shelf only once.
+        Return a list of (array, identifier) pairs as returned from load.
+        """
+        located = [self.locate(identifier, bestapprox)
+                   for identifier in identifiers]
+        fd = shelve.open(self.filename)
+        arrays = {}
+        for id in located:
+            if id and id not in arrays:
+                arrays[id] = fd[id]
+        fd.close()
+        return [(arrays[id], id) if id else (None, "not found")
+                for id in located]
+
+    def load_range(self, t0, t1, key=float):
+        """
+        Load all NumPy arrays with identifiers id such that
+        t0 <= key(id) <= t1 (see NumPyDB.load_range).
+        Return a list of (array, identifier) pairs sorted on key.
+        """
+        return self.load_many(_in_range(self._sorted_index,
+                                        self.keys, t0, t1, key))
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locking on this platform
+
+def _lock(f, exclusive):
+    """Lock the open file f (shared lock if exclusive is false)."""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _copy_bytes(fd_in, fd_out, nbytes, chunk_size=2**20):
+    """Copy nbytes bytes from file fd_in to file fd_out."""
+    while nbytes > 0:
+        data = fd_in.read(min(chunk_size, nbytes))
+        if not data:
+            break
+        fd_out.write(data)
+        nbytes -= len(data)
+
+def _replace(src, dst):
+    """Rename file src to dst, overwriting dst."""
+    if os.name == 'nt' and os.path.isfile(dst):
+        os.remove(dst)  # rename does not overwrite on Windows
+    os.rename(src, dst)
+
+
+class _AsyncDumper(threading.Thread):
+    """
+    Background thread that calls dump(a, identifier) for arrays
+    put in a queue, with a limit on the total number of queued bytes.
+    """
+    def __init__(self, dump, max_queued_bytes):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dump = dump
+        self.max_queued_bytes = max_queued_bytes
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.stopping = False
+        self.error = None  # sys.exc_info() for an exception in dump
+        self.condition = threading.Condition()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, a, identifier):
+        nbytes = getattr(a, 'nbytes', 0)
+        self.condition.acquire()
+        try:
+            self._raise_error()
+            # back pressure (a single large array is always accepted):
+            while self.queue and \
+                  self.queued_bytes + nbytes > self.max_queued_bytes:
+                self.condition.wait()
+                self._raise_error()
+            self.queue.append((a, identifier, nbytes))
+            self.queued_bytes += nbytes
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait(self):
+        """Wait until the queue is empty and everything is written."""
+        self.condition.acquire()
+        try:
+            while self.queue and self.error is None:
+                self.condition.wait()
+            self._raise_error()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        self.condition.acquire()
+        self.stopping = True
+        self.condition.notifyAll()
+        self.condition.release()
+        self.join()
+        self._raise_error()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return  # stopped and nothing more to write
+                a, identifier, nbytes = self.queue[0]
+            finally:
+                self.condition.release()
+            try:
+                self.dump(a, identifier)
+            except:
+                error = sys.exc_info()
+            else:
+                error = None
+            self.condition.acquire()
+            try:
+                self.queue.popleft()
+                self.queued_bytes -= nbytes
+                if error is not None:
+                    # drop the rest of the queue and report the error
+                    self.error = error
+                    self.queue.clear()
+                    self.queued_bytes = 0
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+
+class _SortedIdentifiers:
+    """
+    Identifiers sorted by a numeric key, for finding the identifier
+    closest to a given one by bisection.
+    """
+    def __init__(self, identifiers, key):
+        # sort on (key, storage index) such that the last of several
+        # equal keys is the most recently stored identifier
+        items = sorted([(key(id), i) for i, id in enumerate(identifiers)])
+        self.keys = [k for k, i in items]
+        self.order = [i for k, i in items]
+
+    def nearest(self, value):
+        """
+        Return the storage index of the identifier whose key is
+        closest to value. Ties are resolved in favor of the most
+        recently stored identifier (as in a linear search with <=).
+        """
+        n = len(self.keys)
+        i = bisect.bisect_left(self.keys, value)
+        candidates = []
+        if i > 0:
+            candidates.append(i-1)
+        if i < n:
+            # last of the (possibly repeated) keys above value:
+            candidates.append(bisect.bisect_right(self.keys, self.keys[i])-1)
+        best = None
+        for c in candidates:
+            d = abs(self.keys[c] - value)
+            if best is None or d < best[0] or \
+               (d == best[0] and self.order[c] > best[1]):
+                best = (d, self.order[c])
+        return best[1]
+
+    def between(self, value0, value1):
+        """
+        Return the storage indices of the identifiers with keys in
+        [value0, value1], sorted on key.
+        """
+        return self.order[bisect.bisect_left(self.keys, value0):
+                          bisect.bisect_right(self.keys, value1)]
+
+
+def _sorted(sorted_index, identifiers, key):
+    """
+    Return the _SortedIdentifiers object for identifiers and the key
+    function key, or None if some identifier has no numeric key.
+    The objects are cached in the dictionary sorted_index.
+    """
+    if key not in sorted_index:
+        try:
+            sorted_index[key] = _SortedIdentifiers(identifiers, key)
+        except ValueError:
+            sorted_index[key] = None
+    return sorted_index[key]
+
+
+def _in_range(sorted_index, identifiers, t0, t1, key):
+    """
+    Return the distinct identifiers id with t0 <= key(id) <= t1,
+    sorted on key. Identifiers without a numeric key are skipped.
+    """
+    index = _sorted(sorted_index, identifiers, key)
+    if index is not None:
+        selected = [identifiers[i] for i in index.between(t0, t1)]
+    else:
+        items = []
+        for i, id in enumerate(identifiers):
+            try:
+                k = key(id)
+            except ValueError:
+                continue
+            if t0 <= k <= t1:
+                items.append((k, i, id))
+        items.sort()
+        selected = [id for k, i, id in items]
+    distinct = []
+    found = set()
+    for id in selected:
+        if id not in found:
+            found.add(id)
+            distinct.append(id)
+    return distinct
+
+
+def _nearest(sorted_index, bestapprox, identifiers, identifier):
+    """
+    Return the index in the list identifiers of the identifier
+    closest to identifier, measured by the distance function bestapprox.
+    """
+    key = getattr(bestapprox, 'key', None)
+    if key is not None:
+        index = _sorted(sorted_index, identifiers, key)
+        if index is not None:
+            try:
+                return index.nearest(key(identifier))
+            except ValueError:
+                pass
+    # linear search:
+    selected = 0
+    min_dist = bestapprox(identifiers[0], identifier)
+    for i, id in enumerate(identifiers):
+        d = bestapprox(id, identifier)
+        if d <= min_dist:
+            selected = i
+            min_dist = d
+    return selected
+
 # np.load/dump
 # joblib.load/dump
 
@@ -250,9 +1150,16 @@ def float_dist(id1, id2):
     as strings).
     This function is typically used when time values are
     used as identifiers.
+
+    The key attribute of the function tells NumPyDB that the distance
+    is abs(key(id1) - key(id2)), which enables fast lookup in a
+    sorted index. User-defined distance functions of the same type
+    can set a key attribute too.
     """
     return abs(float(id1) - float(id2))
 
+float_dist.key = float
+
 
 def _test_dist(id1, id2):
     """
@@ -266,19 +1173,31 @@ def _test_dist(id1, id2):
     d = abs(float(t1) - float(t2))
     return d
 
+_test_dist.key = lambda id: float(id[5:])
+
+# constructors for the database backends, used in main and benchmark:
+_backends = {
+    'text': NumPyDB_text,
+    'pickle': NumPyDB_pickle,
+    'cPickle': NumPyDB_cPickle,
+    'shelve': NumPyDB_shelve,
+    'mmap': NumPyDB_mmap,
+    'mmap-zlib': lambda name, mode: NumPyDB_mmap(name, mode, codec='zlib'),
+    }
+
+def _remove_database(name):
+    """Remove all files of database name (for all backends)."""
+    # (shelve may add extensions depending on the underlying dbm module)
+    for ext in '', '.dat', '.map', '.idx', '.dir', '.bak', '.db', '.pag':
+        if os.path.isfile(name + ext):
+            os.remove(name + ext)
+
 def main(n, length, method, name):
     out = "dumping/loading %d %d-arrays data with the %s method took" \
           % (n,length,method)
-    if method == "pickle":
-        dataout = NumPyDB_pickle(name, 'store')
-    elif method == "cPickle":
-        dataout = NumPyDB_cPickle(name, 'store')
-    elif method == "shelve":
-        dataout = NumPyDB_shelve(name, 'store')
-    elif method == "text":
-        dataout = NumPyDB_text(name, 'store')
-    else:
+    if method not in _backends:
         raise ValueError("illegal method name='%s'" % method)
+    dataout = _backends[method](name, 'store')
 
     import time
     t0 = time.clock()
@@ -289,16 +1208,7 @@ def main(n, length, method, name):
 
         dataout.dump(u, 'time=%e' % float(i))
 
-    if method == "pickle":
-        datain = NumPyDB_pickle(name, 'load')
-    elif method == "cPickle":
-        datain = NumPyDB_cPickle(name, 'load')
-    elif method == "shelve":
-        datain = NumPyDB_shelve(name, 'load')
-    elif method == "text":
-        datain = NumPyDB_text(name, 'load')
-    else:
-        raise ValueError("illegal method name='%s'" % method)
+    datain = _backends[method](name, 'load')
 
     w = datain.load('time=4')
     print "identifier='time=4':", w
@@ -318,17 +1228,176 @@ def main(n, length, method, name):
     elif os.path.isfile(name):  # shelve technique leads to no extension
         filesize = os.path.getsize(name)/1000000.0
     print "filesize=%.2fMb\n\n" % filesize
-    for filename in (name+'.dat', name+'.map', name):
-        if os.path.isfile(filename):
-            os.remove(filename)
+    _remove_database(name)
+
+
+def _peak_memory():
+    """Return the peak resident memory of this process in kB (or None)."""
+    try:
+        import resource
+    except ImportError:
+        return None  # not available on Windows
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024  # bytes on Mac OS X, kB on Linux
+    return rss
+
+def benchmark(backend, nrecords, length, name='tmpdata_benchmark',
+              nlookups=100, seed=1):
+    """
+    Measure the performance of a NumPyDB backend (a key in _backends)
+    for a database with nrecords arrays of length floats.
+    The identifiers are time values ('%.6e' % t).
+    Return a dictionary with the measurements:
+
+    ====================  ==============================================
+    Key                   Description
+    ====================  ==============================================
+    dump_MBps             throughput (MB/s) when dumping all arrays
+    open_s                time for opening the database in load mode
+                          and looking up the first identifier
+    load_MBps             throughput (MB/s) when loading all arrays
+                          (with load_many if available)
+    random_load_ms        mean time of loading a random array (ms)
+    bestapprox_load_ms    mean time of loading the array closest to a
+                          random time value, with bestapprox=float_dist
+    filesize_MB           size of the database files
+    peak_memory_kB        peak memory (of the process) during the run
+    ====================  ==============================================
+    """
+    import random, timeit
+    timer = timeit.default_timer
+    random.seed(seed)
+    result = {'backend': backend, 'nrecords': nrecords, 'length': length}
+    memory0 = _peak_memory()
+    _remove_database(name)
+    nbytes = 8.0*nrecords*length
+    identifiers = ['%.6e' % i for i in range(nrecords)]
+    u = numpy.random.uniform(size=length)  # many digits (for text)
+
+    db = _backends[backend](name, 'store')
+    t0 = timer()
+    for identifier in identifiers:
+        db.dump(u, identifier)
+    result['dump_MBps'] = nbytes/1E+6/(timer() - t0)
+
+    t0 = timer()
+    db = _backends[backend](name, 'load')
+    db.load(identifiers[0])
+    result['open_s'] = timer() - t0
+
+    t0 = timer()
+    if hasattr(db, 'load_many'):
+        arrays = db.load_many(identifiers)
+    else:
+        arrays = [db.load(identifier) for identifier in identifiers]
+    for a, identifier in arrays:
+        a.sum()  # make sure that memmap data are actually read
+    del arrays
+    result['load_MBps'] = nbytes/1E+6/(timer() - t0)
+
+    t0 = timer()
+    for i in range(nlookups):
+        a, identifier = db.load(random.choice(identifiers))
+        a.sum()
+    result['random_load_ms'] = (timer() - t0)/nlookups*1000
+
+    t0 = timer()
+    for i in range(nlookups):
+        t = random.uniform(0, nrecords-1)
+        a, identifier = db.load('%.10e' % t, bestapprox=float_dist)
+        a.sum()
+    result['bestapprox_load_ms'] = (timer() - t0)/nlookups*1000
+
+    result['filesize_MB'] = sum([os.path.getsize(name + ext)
+                                 for ext in '', '.dat', '.map', '.dir', '.db'
+                                 if os.path.isfile(name + ext)])/1E+6
+    memory = _peak_memory()
+    if memory is not None:
+        result['peak_memory_kB'] = memory
+        result['start_memory_kB'] = memory0
+    _remove_database(name)
+    return result
+
+def _benchmark_in_process(queue, args):
+    try:
+        queue.put(benchmark(*args))
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (e.__class__.__name__, e)})
+
+def benchmark_suite(backends=None, nrecords=(10, 1000), lengths=(10, 10000),
+                    outfile=sys.stdout, name='tmpdata_benchmark',
+                    timeout=3600):
+    """
+    Run benchmark for all combinations of backends (default: all),
+    numbers of records (nrecords), and array lengths (lengths).
+    Each benchmark runs in a separate process such that the peak
+    memory is measured for one case only.
+    The results are written to outfile (and returned) as one JSON
+    dictionary per line, see benchmark for the keys.
+    A case whose process dies, or runs for more than timeout seconds,
+    gives a dictionary with an 'error' key.
+    """
+    import json, multiprocessing, time, Queue
+    if backends is None:
+        backends = sorted(_backends.keys())
+    results = []
+    for backend in backends:
+        for n in nrecords:
+            for length in lengths:
+                queue = multiprocessing.Queue()
+                args = (backend, n, length, '%s_%s' % (name, backend))
+                p = multiprocessing.Process(target=_benchmark_in_process,
+                                            args=(queue, args))
+                p.start()
+                stop = time.time() + timeout
+                while True:
+                    try:
+                        result = queue.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        if not p.is_alive():
+                            try:  # (the result may arrive just before exit)
+                                result = queue.get(timeout=1)
+                            except Queue.Empty:
+                                result = {'error': 'process died '
+                                          '(exitcode %s)' % p.exitcode}
+                            break
+                        if time.time() > stop:
+                            p.terminate()
+                            result = {'error': 'timeout after %g s' %
+                                      timeout}
+                            break
+                p.join()
+                if 'error' in result:
+                    _remove_database(args[3])
+                result.update({'backend': backend, 'nrecords': n,
+                               'length': length})
+                outfile.write(json.dumps(result, sort_keys=True) + '\n')
+                outfile.flush()
+                results.append(result)
+    return results
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        # python NumPyDB.py benchmark [nrecords [lengths [backends]]]
+        # (comma-separated lists), e.g.,
+        # python NumPyDB.py benchmark 10,1000 10,100000 cPickle,mmap
+        kwargs = {}
+        try:
+            kwargs['nrecords'] = [int(n) for n in sys.argv[2].split(',')]
+            kwargs['lengths'] = [int(n) for n in sys.argv[3].split(',')]
+            kwargs['backends'] = sys.argv[4].split(',')
+        except IndexError:
+            pass
+        benchmark_suite(**kwargs)
+        sys.exit(0)
     try:     n = int(sys.argv[1])
     except:  n = 12
     try:     length = int(sys.argv[2])
     except:  length = 10
     try:     methods = [sys.argv[3]]
-    except:  methods = ['pickle','cPickle','shelve','text']
+    except:  methods = ['pickle','cPickle','shelve','text','mmap']
     print 'NumPy array type:', basic_NumPy
     for method in methods:
         main(n, length, method, "tmpdata_" + method)
@@ -14,10 +14,18 @@ This module provides functions for
     As read, but the columns are returned as separate arrays instead
     of a two-dimensional array.
 
+  - iter_blocks:
+    As read, but the table is returned in chunks of a fixed number
+    of rows (for tables too large to be held in memory).
+
   - write_columns:
     As write, but the arguments are comma-separated one-dimensional
     arrays, one for each column, instead of a two-dimensional array.
 
+  - readfile, writefile:
+    As read_columns and write, but with a filename instead of
+    a file object (.gz files are compressed with gzip).
+
 The file format requires the same number of "words" (numbers)
 on each line. Comment lines are allowed, but a blank line
 indicates a delimiter in the data set, and lines after the blank
@@ -75,11 +83,11 @@ The `tmp2.dat` file looks as follows::
 """
 # author: Hans Petter Langtangen <hpl@ifi.uio.no>
 
-import sys, os, re
+import sys, os, re, itertools, binascii
 from numpy import *
 
-__all__ = ['read', 'read_columns', 'readfile',
-           'write', 'write_columns',]
+__all__ = ['read', 'read_columns', 'readfile', 'iter_blocks',
+           'write', 'write_columns', 'writefile',]
 
 # simple version (not as effective as function read):
 def read_v1(fileobj, commentchar='#'):
@@ -95,13 +103,30 @@ def read_v1(fileobj, commentchar='#'):
     return array(r)
 
 
-def read(fileobj, commentchar='#'):
+# with nprocs > 1 in read, files (the part to be read) larger than
+# this are read in parallel:
+parallel_threshold = 2**26  # bytes
+
+def read(fileobj, commentchar='#', usecols=None, all_blocks=False,
+         nprocs=1):
     """
     Load a table with numbers into a two-dim. NumPy array.
     @param fileobj: open file object.
     @param commentchar: lines starting with commentchar are skipped
     (a blank line is an array data delimiter and stops reading).
-    @return: two-dimensional (row-column) NumPy array.
+    @param usecols: sequence of column indices; if given, only these
+    columns are converted and returned (in the given order).
+    @param all_blocks: if true, read all blank-line separated data
+    sets in the rest of the file (the number of columns may differ
+    from data set to data set).
+    @param nprocs: number of processes for parsing large files
+    (None means the number of CPUs). If nprocs > 1 and the data to
+    be read exceed parallel_threshold bytes, the data are split at
+    line boundaries and the parts are parsed in parallel by a pool
+    of processes (not for all_blocks=True, and not when called from
+    a daemonic process such as a multiprocessing.Pool worker).
+    @return: two-dimensional (row-column) NumPy array, or a list of
+    such arrays (one for each data set) if all_blocks is true.
     """
     # based on a version by Mario Pernici <Mario.Pernici@mi.infn.it>
     location = fileobj.tell()
@@ -115,38 +140,236 @@ def read(fileobj, commentchar='#'):
         else: break
 
     shape1 = len(line.split())
-    if shape1 == 0: return None
+    if shape1 == 0 and not all_blocks: return None
     fileobj.seek(location)
+    if nprocs != 1 and not all_blocks and isinstance(fileobj, file):
+        import multiprocessing
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        # (daemonic processes, e.g. Pool workers, cannot have children)
+        if nprocs > 1 and not multiprocessing.current_process().daemon:
+            fileobj.seek(0, 2)
+            if fileobj.tell() - location > parallel_threshold:
+                return _read_parallel(fileobj, location, commentchar,
+                                      shape1, usecols, nprocs)
+            fileobj.seek(location)
 
     blankline = re.compile('\n\s*\n',  re.M)
     commentline = re.compile('^%s[^\n]*\n' % commentchar, re.M)
     filestr = fileobj.read()
+    if all_blocks:
+        # skip lines starting with the comment character
+        filestr = re.sub(commentline, '', filestr)
+        blocks = [block.strip() for block in re.split(blankline, filestr)]
+        return [_convert(block, len(block.split('\n', 1)[0].split()),
+                         usecols) for block in blocks if block]
     # remove lines after a blank line
     m = re.search(blankline, filestr)
     if m:
         filestr = filestr[:m.start()+1]
     # skip lines starting with the comment character
     filestr = re.sub(commentline, '', filestr)
-    a = [float(x) for x in filestr.split()]
-    data = array(a)
-    data.shape = (len(a)/shape1, shape1)
+    return _convert(filestr, shape1, usecols)
+
+def _read_parallel(fileobj, location, commentchar, shape1, usecols,
+                   nprocs):
+    """
+    As read, but let a pool of nprocs processes parse parts of the
+    data (from location to the first blank line in fileobj).
+    """
+    import mmap, multiprocessing
+    size = os.fstat(fileobj.fileno()).st_size
+    m = mmap.mmap(fileobj.fileno(), size, access=mmap.ACCESS_READ)
+    blankline = re.compile('\n\s*\n',  re.M)
+    match = blankline.search(m, location)
+    stop = match.start()+1 if match else size
+    # split the data in parts of approx. equal size, at line boundaries:
+    bounds = [location]
+    for i in range(1, nprocs):
+        pos = m.find('\n', location + (stop - location)*i/nprocs) + 1
+        if 0 < pos < stop and pos > bounds[-1]:
+            bounds.append(pos)
+    bounds.append(stop)
+    m.close()
+    fileobj.seek(0, 2)  # as if read had consumed the file
+
+    tasks = [(fileobj.name, start, end, commentchar, shape1, usecols)
+             for start, end in zip(bounds[:-1], bounds[1:])]
+    if len(tasks) == 1:
+        return _read_part(tasks[0])  # (no need for a pool)
+    pool = multiprocessing.Pool(len(tasks))
+    try:
+        parts = pool.map(_read_part, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return concatenate(parts)
+
+def _read_part(args):
+    """Parse bytes start:end in a file (task in _read_parallel)."""
+    filename, start, end, commentchar, shape1, usecols = args
+    f = open(filename, 'rb')
+    f.seek(start)
+    filestr = f.read(end - start)
+    f.close()
+    commentline = re.compile('^%s[^\n]*\n' % commentchar, re.M)
+    filestr = re.sub(commentline, '', filestr)
+    return _convert(filestr, shape1, usecols)
+
+def _convert(filestr, shape1, usecols=None):
+    """
+    Convert the words in filestr, a table with shape1 columns,
+    to a two-dim. array (with the columns in usecols only).
+    """
+    words = filestr.split()
+    if usecols is None:
+        data = fromiter(itertools.imap(float, words), float, len(words))
+        data.shape = (len(words)/shape1, shape1)
+        return data
+    shape0 = len(words)/shape1
+    if len(words) != shape0*shape1:
+        raise ValueError('rows with different lengths in table')
+    data = empty((shape0, len(usecols)))
+    for i, column in enumerate(usecols):
+        if not -shape1 <= column < shape1:
+            raise IndexError('column %d does not exist (%d columns)' %
+                             (column, shape1))
+        # pick every shape1-th word only, skipped words are not converted
+        data[:,i] = fromiter(itertools.imap(float, itertools.islice(
+            words, column % shape1, None, shape1)), float, shape0)
     return data
 
 
-def read_columns(fileobj, commentchar='#'):
-    """As read. Return columns as separate arrays."""
-    a = read(fileobj, commentchar)
+def read_columns(fileobj, commentchar='#', cache=False,
+                 usecols=None, all_blocks=False):
+    """
+    As read. Return columns as separate arrays
+    (or, if all_blocks is true, a list of such column lists,
+    one for each data set).
+
+    If cache is true and fileobj is a file on disk, the columns are
+    also stored in a binary .npy "sidecar" file next to the data file
+    (the name of the sidecar reflects the size and modification time
+    of the data file). Subsequent calls with cache=True read the
+    columns from the sidecar, as memory-mapped arrays, instead of
+    parsing the text again, as long as the data file is unchanged.
+    The sidecar always contains all columns (usecols just selects
+    columns from it), and cache cannot be combined with all_blocks.
+    The columns are writable in both cases: the sidecar is mapped
+    copy-on-write (mmap_mode='c'), so changes to the returned arrays
+    are never written back to the sidecar.
+    """
+    filename = getattr(fileobj, 'name', None)
+    if cache and all_blocks:
+        raise ValueError('cache=True cannot be used with all_blocks=True')
+    if cache and filename is not None and os.path.isfile(filename):
+        columns = _read_columns_cached(fileobj, commentchar)
+        if usecols is None:
+            return columns
+        return [columns[i] for i in usecols]
+    a = read(fileobj, commentchar, usecols, all_blocks)
+    if all_blocks:
+        return [[b[:,i] for i in range(b.shape[1])] for b in a]
     return [a[:,i] for i in range(a.shape[1])]
 
+def _cachename(filename, offset, commentchar):
+    """Return the name of the .npy sidecar file for filename."""
+    s = os.stat(filename)
+    return '%s.cache-%d-%d-%d-%s.npy' % \
+           (filename, s.st_size, int(s.st_mtime*1E+6), offset,
+            binascii.hexlify(commentchar))
+
+def _read_columns_cached(fileobj, commentchar):
+    filename = fileobj.name
+    cachename = _cachename(filename, fileobj.tell(), commentchar)
+    if os.path.isfile(cachename):
+        try:
+            fileobj.seek(0, 2)  # as if read had consumed the file
+        except ValueError:
+            pass  # gzip files cannot seek from the end
+        return list(load(cachename, mmap_mode='c'))
+
+    a = read(fileobj, commentchar)
+    columns = ascontiguousarray(a.transpose())
+    # remove sidecars for previous versions of the file:
+    dirname, basename = os.path.split(filename)
+    prefix = basename + '.cache-'
+    version = os.path.basename(cachename)[len(prefix):].split('-')[:2]
+    for name in os.listdir(dirname or os.curdir):
+        if name.startswith(prefix) and name.endswith('.npy') and \
+           name[len(prefix):].split('-')[:2] != version:
+            try:
+                os.remove(os.path.join(dirname, name))
+            except OSError:
+                pass
+    # write to a temporary file first such that other processes
+    # never see an incomplete sidecar:
+    tmpname = '%s.%d.tmp' % (cachename, os.getpid())
+    try:
+        f = open(tmpname, 'wb')
+        save(f, columns)
+        f.close()
+        os.rename(tmpname, cachename)
+    except (IOError, OSError):
+        pass  # no write permission, full disk etc. - just don't cache
+    return list(columns)
+
+def iter_blocks(fileobj, chunk_rows=10000, commentchar='#'):
+    """
+    As read, but the table is parsed incrementally and returned as a
+    sequence of two-dim. NumPy arrays with (at most) chunk_rows rows.
+    Only one chunk is held in memory at a time, which makes it possible
+    to process very large files::
+
+        f = open('huge.dat', 'r')
+        for chunk in iter_blocks(f, chunk_rows=100000):
+            ymax = max(ymax, chunk[:,1].max())
+
+    The numbers are parsed into one preallocated (chunk_rows, ncolumns)
+    array, and each chunk is a view of (the first rows of) this array:
+    a chunk is overwritten by the next iteration and must be copied
+    (chunk.copy()) if it is to be kept.
+
+    As in read, the iteration stops at the first blank line. The file
+    is then positioned after the blank line such that the next data
+    set in the file can be read by a new call.
+    """
+    buffer = None
+    lines = []
+    while True:
+        line = fileobj.readline()
+        end = not line or line.isspace()  # end of file or blank line
+        if not end and not line.startswith(commentchar):
+            lines.append(line)
+        if len(lines) == chunk_rows or (end and lines):
+            if buffer is None:
+                ncolumns = len(lines[0].split())
+                # (a file with less than chunk_rows rows needs no more)
+                buffer = empty((len(lines), ncolumns))
+                flat = buffer.reshape(-1)
+            words = ''.join(lines).split()
+            if len(words) != len(lines)*ncolumns:
+                raise ValueError('rows with different lengths in chunk '
+                                 'ending with\n%s' % lines[-1])
+            # convert directly into the buffer (no list of floats):
+            flat[:len(words)] = words
+            yield buffer[:len(lines)]
+            lines = []
+        if end:
+            break
+
 # for backward compatibility:
-def readfile(filename, commentchar='#'):
+def readfile(filename, commentchar='#', cache=False,
+             usecols=None, all_blocks=False):
     """
-    As read, but a filename (and not a file object) can be given.
+    As read, but a filename (and not a file object) can be given
+    (files with extension .gz are gzip compressed).
     Return: columns as separate arrays.
+    See read_columns for the remaining arguments.
     """
-    f = open(filename, 'r')
-    a = read(f, commentchar)
-    r = [a[:,i] for i in range(a.shape[1])]
+    f = _open(filename, 'r')
+    r = read_columns(f, commentchar, cache, usecols, all_blocks)
+    f.close()
     return r
 
 
@@ -188,38 +411,59 @@ def write_v3(fileobj, a):
     # written by Mario Pernici <Mario.Pernici@mi.infn.it>
     fileobj.write(('%g\t'*(a.shape[1]-1) + '%g\n')*a.shape[0] % tuple(ravel(a)))
 
-def write(fileobj, a):
-    """Write a two-dim. NumPy array a in tabular form to fileobj."""
-    # fastest version (of the write family of functions) so far...
-    # written by Mario Pernici <Mario.Pernici@mi.infn.it>
-    
+def write(fileobj, a, fmt='%g', delimiter='\t', precision=None):
+    """
+    Write a two-dim. NumPy array a in tabular form to fileobj.
+    @param fmt: printf format for the numbers, either one format
+    for all columns or a list with one format per column.
+    @param delimiter: string between the columns.
+    @param precision: if given, fmt is set to '%.<precision>g'.
+    """
+    # based on a version by Mario Pernici <Mario.Pernici@mi.infn.it>,
+    # where a big format string is applied to many rows at a time
     if len(a.shape) != 2:
         raise TypeError("a 2D array is required, shape now is "+str(a.shape))
-    N = 512
-    shape0 = a.shape[0]
-    shape1 = a.shape[1]
-    str_fmt = '%g\t'*(shape1 - 1) + '%g\n'
-    # use a big format string
-    str_fmt_N = str_fmt * N
-    for i in xrange(shape0/N):
-      a1 = a[i:i+N,:]
-      # put a1 in  1D array form; ravel better than reshape for
-      # non-contiguous arrays.
-      a1 = ravel(a1)
-      fileobj.write(str_fmt_N % tuple(a1))
-    for i in range(shape0 - shape0%N, shape0):
-      fileobj.write(str_fmt % tuple(a[i]))
-
-
-def write_columns(fileobj, *columns):
+    shape0, shape1 = a.shape
+    if precision is not None:
+        fmt = '%%.%dg' % precision
+    if isinstance(fmt, basestring):
+        fmt = [fmt]*shape1
+    elif len(fmt) != shape1:
+        raise ValueError('%d formats for %d columns' % (len(fmt), shape1))
+    str_fmt = delimiter.join(fmt) + '\n'
+    # format and write chunks of about 2**16 numbers; tolist converts
+    # the whole chunk to Python floats in one (C) operation, which is
+    # much faster than tuple(ravel(a1)) (a tuple of NumPy scalars)
+    N = max(1, 2**16/max(1, shape1))
+    for i in xrange(0, shape0, N):
+        a1 = a[i:i+N,:]
+        fileobj.write(str_fmt*a1.shape[0] % tuple(a1.ravel().tolist()))
+
+def write_columns(fileobj, *columns, **kwargs):
     """
     As write, but the column data are represented as one-dimensional
-    arrays.
+    arrays. Keyword arguments (fmt etc.) are passed on to write.
     """
     a = array(columns).transpose()
-    write(fileobj, a)
-    
-    
+    write(fileobj, a, **kwargs)
+
+def writefile(filename, a, **kwargs):
+    """
+    As write, but a filename (and not a file object) is given.
+    If the filename ends with .gz, the file is gzip compressed.
+    """
+    f = _open(filename, 'w')
+    write(f, a, **kwargs)
+    f.close()
+
+def _open(filename, mode='r'):
+    """Open a plain file, or a gzip file if filename ends with .gz."""
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, mode + 'b')
+    return open(filename, mode)
+
+
 # testing:
 def _generate(nrows, ncolumns, filename):
     f = open(filename, 'w')
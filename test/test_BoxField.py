@@ -0,0 +1,304 @@
+import sys, types, itertools
+import numpy
+from numpy import array, allclose, zeros, arange
+try:
+    import dolfin
+except ImportError:
+    # BoxField imports dolfin at module level, only the conversion
+    # functions use it (and the tests monkeypatch what they need)
+    dolfin = types.ModuleType('dolfin')
+    dolfin.__version__ = '1.6'
+    sys.modules['dolfin'] = dolfin
+from scitools.BoxField import *
+
+def _grids():
+    return [UniformBoxGrid(min=(-1,0), max=(1,3), division=(4,6)),
+            UniformBoxGrid(min=(0,0,0), max=(1,2,1), division=(2,4,4)),
+            BoxGrid([array([0, 0.1, 0.3, 1, 1.2]), array([-1, 0, 2.])])]
+
+def _linear(*x):
+    return 2 + sum([(i + 1)*c for i, c in enumerate(x)])
+
+def _field(grid, f=_linear, **kwargs):
+    u = BoxField(grid, 'u', **kwargs)
+    u.values[...] = grid.vectorized_eval(f)
+    return u
+
+def test_interpolate():
+    for g in _grids():
+        points = g.min_coor + \
+             numpy.random.RandomState(2).rand(30, g.nsd)*(g.max_coor -
+                                                          g.min_coor)
+        exact = _linear(*points.T)
+        u = _field(g)
+        assert allclose(u.interpolate(points), exact)
+        v = BoxField(g, 'v', vector=2)
+        v.values[0] = u.values
+        v.values[1] = 2*u.values
+        values = v.interpolate(points)
+        assert values.shape == (2, len(points))
+        assert allclose(values[0], exact) and allclose(values[1], 2*exact)
+
+def test_gridline_gridplane():
+    g = _grids()[0]
+    u = _field(g)
+    # a line on a grid line:
+    x, values, fixed, snapped = u.gridline((-1, 1.5), 0)
+    assert allclose(x, g.coor[0]) and allclose(values, _linear(x, 1.5))
+    assert not snapped and fixed == 1.5
+    # a line between the grid lines, interpolated:
+    x, values, fixed, snapped = u.gridline((-0.8, 1.2), 0, (0.9, 1.2),
+                                           snap=False)
+    assert x[0] == -0.8 and x[-1] == 0.9 and (numpy.diff(x) > 0).all()
+    assert allclose(x[1:-1], [-0.5, 0, 0.5])
+    assert allclose(values, _linear(x, 1.2)) and not snapped
+    # resampled:
+    y, values, fixed, snapped = u.gridline((0.3, 0), 1, snap=False,
+                                           npoints=7)
+    assert allclose(y, numpy.linspace(0, 3, 7))
+    assert allclose(values, _linear(0.3, y)) and fixed == 0.3
+    x, values, fixed, snapped = u.gridline((0.3, 0.4), 0, npoints=5)
+    assert snapped and fixed == 0.5  # snapped to y=0.5
+    assert allclose(values, _linear(x, 0.5))
+
+    g = _grids()[1]
+    u = _field(g)
+    y, z, values, fixed, snapped = u.gridplane(0.7, 0, snap=False)
+    assert allclose(y, g.coor[1]) and allclose(z, g.coor[2])
+    assert allclose(values, _linear(0.7, y[:,None], z[None,:]))
+    assert values.shape == (len(y), len(z)) and not snapped
+    x, z, values, fixed, snapped = u.gridplane(0.7, 1, npoints=(3, 4))
+    assert allclose(x, [0, 0.5, 1]) and len(z) == 4
+    assert snapped and fixed == 0.5
+    assert allclose(values, _linear(x[:,None], 0.5, z[None,:]))
+    v = BoxField(g, 'v', vector=3)
+    v.values[:] = u.values
+    x, z, values, fixed, snapped = v.gridplane(0.7, 1, snap=False,
+                                               npoints=3)
+    assert values.shape == (3, 3, 3)
+    assert allclose(values[2], _linear(x[:,None], 0.7, z[None,:]))
+
+def test_memmap_values(tmpdir):
+    filename = str(tmpdir.join('u.dat'))
+    g = _grids()[1]
+    u = BoxField(g, 'u', vector=3, filename=filename)
+    assert u._values is None  # not allocated before first access
+    assert isinstance(u.values, numpy.memmap)
+    assert u.values.shape == (3,) + g.shape
+    u.values[1] = g.vectorized_eval(_linear)
+    u.flush()
+
+    # an existing file is opened with mode r+:
+    v = BoxField(g, 'v', vector=3, filename=filename)
+    assert v.mode == 'r+' and allclose(v.values[1], u.values[1])
+    assert (v.values[0] == 0).all()
+    v = BoxField(g, 'v', vector=3, filename=filename, mode='r')
+    assert not v.values.flags.writeable
+    v = BoxField(g, 'v', vector=3, filename=filename, mode='w+')
+    assert (v.values == 0).all()
+
+    u = BoxField(g, 'u')
+    assert u._values is None
+    assert not isinstance(u.values, numpy.memmap)
+    assert u.values.shape == g.shape
+    u.flush()  # (nothing to do)
+
+def test_decompose_halo_gather():
+    for g in _grids():
+        for vector in 0, 2:
+            u = _field(g, vector=vector)
+            for nparts, ghost in (2, 1), ([2] + [2]*(g.nsd-1), 2):
+                pieces = decompose(u, nparts, ghost)
+                for p in pieces:
+                    assert allclose(p.values, u.values[p.global_index])
+                    # update the owned points only:
+                    owned = p.values[p.owned].copy()
+                    p.values[...] = -1
+                    p.values[p.owned] = 2*owned
+                halo_exchange(pieces, 0)
+                assert allclose(pieces[0].values,
+                                2*u.values[pieces[0].global_index])
+                halo_exchange(pieces)
+                for p in pieces:
+                    assert allclose(p.values, 2*u.values[p.global_index])
+                v = gather(pieces, BoxField(g, 'v', vector=vector))
+                assert allclose(v.values, 2*u.values)
+
+    # the pieces share one block of memory (inherited by forked processes):
+    assert numpy.may_share_memory(pieces[0].values, pieces[-1].values) or \
+           pieces[0].values.base is pieces[-1].values.base
+
+def test_apply_stencil():
+    g = _grids()[0]
+    hx, hy = g.delta
+    u = _field(g, lambda x, y: x**2 + 3*y**2 + x*y)
+    laplace = {(0,0): -2/hx**2 - 2/hy**2, (1,0): 1/hx**2, (-1,0): 1/hx**2,
+               (0,1): 1/hy**2, (0,-1): 1/hy**2}
+    lu = u.apply_stencil(laplace)
+    assert allclose(lu[1:-1,1:-1], 8)
+    assert (lu[0] == u.values[0]).all() and (lu[:,-1] == u.values[:,-1]).all()
+    out = zeros(g.shape)
+    lu = u.apply_stencil(laplace.items(), out=out, boundary=lambda x, y: x)
+    assert lu is out and allclose(out[1:-1,1:-1], 8)
+    assert allclose(out[-1,:], 1) and allclose(out[:,0], g.xcoor)
+    try:
+        u.apply_stencil(laplace, out=u.values)
+    except ValueError:
+        pass
+    else:
+        assert False, 'out as the values array not detected'
+    try:
+        u.apply_stencil({0: 1})
+    except ValueError:
+        pass
+    else:
+        assert False, 'wrong offset dimension not detected'
+
+    # a wide one-sided stencil on a vector field:
+    v = BoxField(g, 'v', vector=2)
+    v.values[0] = u.values
+    v.values[1] = g.vectorized_eval(_linear)
+    dx = v.apply_stencil({(0,0): -1.5/hx, (1,0): 2/hx, (2,0): -0.5/hx})
+    assert allclose(dx[1,:-2], 1) and (dx[1,-2:] == v.values[1,-2:]).all()
+
+def test_restrict_prolong():
+    for g in _grids():
+        u = _field(g)
+        fine = u.prolong()
+        assert list(fine.grid.division) == [2*d for d in g.division]
+        # prolongation (linear interpolation) is exact for linear fields:
+        assert allclose(fine.values, fine.grid.vectorized_eval(_linear))
+        # restriction by full weighting as well (on uniform grids):
+        coarse = fine.restrict(g)
+        assert coarse.grid is g
+        if isinstance(g, BoxGrid):
+            # (injection at the boundary)
+            corners = numpy.ix_([0, -1], [0, -1])
+            assert allclose(coarse.values[corners], u.values[corners])
+        else:
+            assert allclose(coarse.values, u.values)
+        v = BoxField(g, 'v', vector=2)
+        v.values[1] = u.values
+        fine = v.prolong()
+        assert fine.values.shape == (2,) + fine.grid.shape
+        assert allclose(fine.values[1], fine.grid.vectorized_eval(_linear))
+    try:
+        u.restrict(g.refine())
+    except ValueError:
+        pass
+    else:
+        assert False, 'incompatible grid not detected'
+    try:
+        _field(UniformBoxGrid(min=(0,0), max=(1,1), division=(3,2))).restrict()
+    except ValueError:
+        pass
+    else:
+        assert False, 'odd division not detected'
+
+class _Mesh(object):
+    """Structured mesh with the DOLFIN numbering of the vertices."""
+    def __init__(self, coor):
+        self._coordinates = array(list(itertools.product(*coor[::-1])))[:,::-1]
+    def coordinates(self):
+        return self._coordinates
+
+class _FunctionSpace(object):
+    def __init__(self, d2v):
+        self.d2v = d2v
+
+class _FunctionSpaceNoWeakref(object):
+    __slots__ = ('d2v', '_scitools_vertex_order')
+    def __init__(self, d2v):
+        self.d2v = d2v
+
+class _Element(object):
+    def __init__(self, degree):
+        self._degree = degree
+    def degree(self):
+        return self._degree
+
+class _Vector(object):
+    def __init__(self, a):
+        self._a = a
+    def array(self):
+        return self._a.copy()
+
+class _Function(object):
+    """P1 function with the values in dof order."""
+    def __init__(self, vertex_values, V, degree=1):
+        self._vector = _Vector(vertex_values[V.d2v])
+        self._V = V
+        self._element = _Element(degree)
+    def vector(self):
+        return self._vector
+    def function_space(self):
+        return self._V
+    def ufl_element(self):
+        return self._element
+    def name(self):
+        return 'u'
+
+def _dof_to_vertex_map(V):
+    _dof_to_vertex_map.calls += 1
+    return V.d2v
+
+def test_dolfin_conversion(monkeypatch):
+    monkeypatch.setattr(dolfin, 'dof_to_vertex_map', _dof_to_vertex_map,
+                        raising=False)
+    for g in _grids()[:2]:
+        mesh = _Mesh(g.coor)
+        u_grid = g.vectorized_eval(_linear)
+        # the vertex values in DOLFIN order and a dof permutation:
+        vertex_values = _linear(*mesh.coordinates().T)
+        for ncomponents in 0, 2:
+            n = g.npoints*max(1, ncomponents)
+            if ncomponents:
+                values = numpy.concatenate([vertex_values, -vertex_values])
+            else:
+                values = vertex_values
+            for V in _FunctionSpace(numpy.random.RandomState(3).permutation(n)), \
+                     _FunctionSpaceNoWeakref(arange(n)[::-1].copy()):
+                _dof_to_vertex_map.calls = 0
+                u = dolfin_function2BoxField(_Function(values, V), mesh,
+                                             division=g.division)
+                assert u.grid.shape == g.shape
+                if ncomponents:
+                    assert u.values.shape == (2,) + g.shape
+                    assert allclose(u.values[0], u_grid)
+                    assert allclose(u.values[1], -u_grid)
+                else:
+                    assert allclose(u.values, u_grid)
+                # the permutation is computed once for V:
+                values2 = 3*values
+                update_from_dolfin_array(values2[V.d2v], u, V)
+                assert _dof_to_vertex_map.calls == 1
+                assert allclose(u.values.ravel()[:g.npoints],
+                                3*u_grid.ravel())
+                # in vertex order (no permutation):
+                update_from_dolfin_array(values, u)
+                assert allclose(u.values.ravel()[:g.npoints],
+                                u_grid.ravel())
+                # into a field with values not from DOLFIN:
+                w = BoxField(g, 'w', vector=ncomponents)
+                update_from_dolfin_array(values2[V.d2v], w, V)
+                assert allclose(w.values, 3*u.values)
+                assert _dof_to_vertex_map.calls == 1
+        V = _FunctionSpace(arange(g.npoints))
+        u = dolfin_function2BoxField(_Function(vertex_values, V), mesh,
+                                     division=g.division,
+                                     uniform_mesh=False)
+        assert isinstance(u.grid, BoxGrid) and allclose(u.values, u_grid)
+
+    try:
+        dolfin_function2BoxField(_Function(vertex_values, V, 2), mesh,
+                                 division=g.division)
+    except TypeError:
+        pass
+    else:
+        assert False, 'degree 2 elements not detected'
+    try:
+        update_from_dolfin_array(vertex_values[:-1], u)
+    except ValueError:
+        pass
+    else:
+        assert False, 'wrong array size not detected'
@@ -0,0 +1,219 @@
+import itertools
+import numpy
+from numpy import array, allclose, zeros, flatnonzero
+from scitools.BoxGrid import UniformBoxGrid, BoxGrid
+
+def _uniform_grids():
+    return [UniformBoxGrid(min=0, max=1, division=4),
+            UniformBoxGrid(min=(-1,0), max=(1,3), division=(4,3)),
+            UniformBoxGrid(min=(0,0,0), max=(1,2,1), division=(2,3,4))]
+
+def _nonuniform_grids():
+    return [BoxGrid([array([0, 0.1, 0.3, 1])]),
+            BoxGrid([array([0, 0.1, 0.3, 1]), array([-1, 0, 2.])]),
+            BoxGrid([array([0, 0.5, 1.]), array([0, 1, 3.]),
+                     array([-2, -1.5, 0, 1])])]
+
+def _points(grid, npoints=40):
+    """Return random points and all grid points in grid."""
+    random = numpy.random.RandomState(1).rand(npoints, grid.nsd)
+    random = grid.min_coor + random*(grid.max_coor - grid.min_coor)
+    grid_points = array(list(itertools.product(*grid.coor)))
+    return numpy.concatenate([random, grid_points])
+
+def test_locate_cells():
+    for g in _uniform_grids():
+        points = _points(g)
+        index, distance, match, nearest = g.locate_cells(points)
+        assert index.shape == distance.shape == match.shape == \
+               nearest.shape == points.shape
+        for p, point in enumerate(points):
+            index_p, distance_p, match_p, nearest_p = \
+                     g.locate_cell(tuple(point))
+            assert index[p].tolist() == index_p
+            assert allclose(distance[p], distance_p)
+            assert match[p].tolist() == match_p
+            assert nearest[p].tolist() == nearest_p
+        assert match[len(points) - g.npoints:].all()  # the grid points
+    g = _uniform_grids()[1]
+    try:
+        g.locate_cells([(0, 0), (1.5, 1)])
+    except ValueError:
+        pass
+    else:
+        assert False, 'point outside the grid not detected'
+
+def test_locate_cells_nonuniform():
+    for g in _nonuniform_grids():
+        points = _points(g)
+        index, distance, match, nearest = g.locate_cells(points)
+        for i in range(g.nsd):
+            coor = g.coor[i]
+            x = points[:,i]
+            assert allclose(distance[:,i], x - coor[index[:,i]])
+            inside = ~match[:,i]
+            # a point that is not on a grid line is inside its cell:
+            assert (coor[index[inside,i]] < x[inside]).all()
+            assert (x[inside] < coor[index[inside,i] + 1]).all()
+            assert allclose(coor[index[match[:,i],i]], x[match[:,i]])
+            assert (abs(coor[nearest[:,i]] - x) <=
+                    abs(coor[index[:,i]] - x) + 1E-14).all()
+        for p, point in enumerate(points):
+            index_p, distance_p, match_p, nearest_p = \
+                     g.locate_cell(tuple(point))
+            assert index[p].tolist() == index_p
+            assert match[p].tolist() == match_p
+            assert nearest[p].tolist() == nearest_p
+
+    # a BoxGrid with uniform coordinates gives the same cells
+    # as the UniformBoxGrid:
+    for g in _uniform_grids():
+        points = _points(g)
+        result = g.locate_cells(points)
+        result_nonuniform = BoxGrid(g.coor).locate_cells(points)
+        for a, b in zip(result, result_nonuniform):
+            assert allclose(a, b)
+
+class _CountingBoxGrid(BoxGrid):
+    calls = 0
+    def _more_init(self):
+        _CountingBoxGrid.calls += 1
+        BoxGrid._more_init(self)
+
+def test_boxgrid_init():
+    coor = [array([0, 0.1, 0.3, 1]), array([-1, 0, 2.])]
+    g = _CountingBoxGrid(coor)
+    assert _CountingBoxGrid.calls == 1
+    assert [c.tolist() for c in g.coor] == [c.tolist() for c in coor]
+    assert g.xcoor is g.coor[0] and g.ycoor is g.coor[1]
+    assert g.shape == (4, 3) and g.npoints == 12
+    assert not hasattr(g, '_given_coor')
+
+def _nlinear(*x):
+    # linear in each coordinate, such that n-linear interpolation is exact
+    return 2 + sum([(i + 1)*c for i, c in enumerate(x)]) - \
+           3*numpy.prod(x, axis=0)
+
+def test_interpolate_points():
+    for g in _uniform_grids()[1:] + _nonuniform_grids()[1:]:
+        v = g.vectorized_eval(_nlinear)
+        points = _points(g)
+        exact = _nlinear(*points.T)
+        assert allclose(g.interpolate_points(v, points), exact)
+        # values with an extra (trailing) dimension:
+        v2 = numpy.concatenate([v[...,None], -v[...,None]], axis=-1)
+        values = g.interpolate_points(v2, points)
+        assert values.shape == (len(points), 2)
+        assert allclose(values[:,0], exact) and allclose(values[:,1], -exact)
+        # vectorized interpolator:
+        f = g.interpolator(v)
+        assert allclose(f(*points.T), exact)
+        assert allclose(f(*points[0]), exact[0])
+    try:
+        g.interpolate_points(zeros((2, 2)), points)
+    except IndexError:
+        pass
+    else:
+        assert False, 'incompatible point_values not detected'
+
+_domain_parts = ['all', 'interior', 'all_boundary', 'interior_boundary',
+                 'corners']
+_edges = ['all_edges', 'interior_edges']
+
+def test_iter_indices():
+    for g in _uniform_grids() + _nonuniform_grids()[1:]:
+        parts = _domain_parts + (_edges if g.nsd == 3 else [])
+        for part in parts:
+            # mark the points covered by the slices:
+            marked = zeros(g.shape, bool)
+            for slices in g.iter(part):
+                marked[slices] = True
+            index = g.indices(part, flat=True)
+            assert (index == flatnonzero(marked)).all(), part
+            assert (numpy.diff(index) > 0).all()
+            indices = g.indices(part)
+            assert len(indices) == g.nsd
+            assert (numpy.ravel_multi_index(indices, g.shape) == index).all()
+            points = list(g.iter(part, False))
+            if g.nsd == 1:
+                assert points == indices[0].tolist()
+            else:
+                assert points == zip(*[i.tolist() for i in indices])
+                assert isinstance(points[0][0], int)
+        if g.nsd < 3:
+            try:
+                g.indices('all_edges')
+            except ValueError:
+                pass
+            else:
+                assert False, 'edges of a %dD grid not detected' % g.nsd
+    # the boundary parts are cached, the parts of the size of the grid not:
+    assert g.indices('corners') is g.indices('corners')
+    assert ('all', False) not in g._indices_cache
+    assert ('interior', True) not in g._indices_cache
+
+def test_vectorized_eval_chunks():
+    for g in _uniform_grids()[1:] + _nonuniform_grids()[1:]:
+        g = g.refine().refine()
+        f = lambda *x: _nlinear(*x) + numpy.sin(x[0])
+        a = g.vectorized_eval(f)
+        coorv = g.__dict__.pop('coorv')
+        for chunk_size, nworkers, pool in [(1, 1, 'thread'),
+                                           (3, 1, 'thread'),
+                                           (None, 3, 'thread'),
+                                           (2, 2, 'process')]:
+            b = g.vectorized_eval(f, chunk_size, nworkers, pool)
+            assert (a == b).all(), (chunk_size, nworkers, pool)
+            # the coordinate arrays of the whole grid are not made:
+            assert 'coorv' not in g.__dict__
+    assert g.xcoorv is g.coorv[0]
+    assert g.xcoorv.shape == g.shape
+    try:
+        g.vectorized_eval(f, nworkers=2, pool='nonexisting')
+    except ValueError:
+        pass
+    else:
+        assert False, 'illegal pool not detected'
+
+def test_decompose():
+    for g in _uniform_grids()[1:] + _nonuniform_grids()[1:]:
+        for nparts, ghost in (2, 1), ([2] + [2]*(g.nsd-1), 1), (1, 0):
+            owned_count = zeros(g.shape, int)
+            for subgrid, global_slices, owned_slices in \
+                    g.decompose(nparts, ghost):
+                assert subgrid.__class__ is g.__class__
+                for c, c_global, s in zip(subgrid.coor, g.coor,
+                                          global_slices):
+                    assert allclose(c, c_global[s])
+                owned = tuple([slice(s.start + o.start, s.start + o.stop)
+                               for s, o in zip(global_slices, owned_slices)])
+                owned_count[owned] += 1
+            # each grid point is owned by exactly one part:
+            assert (owned_count == 1).all()
+    try:
+        g.decompose(g.shape[0] + 1)
+    except ValueError:
+        pass
+    else:
+        assert False, 'too many parts not detected'
+
+def test_coarsen_refine():
+    for g in _uniform_grids()[1:] + _nonuniform_grids()[1:]:
+        fine = g.refine()
+        assert fine.__class__ is g.__class__
+        assert list(fine.division) == [2*d for d in g.division]
+        coarse = fine.coarsen()
+        for c, c_coarse in zip(g.coor, coarse.coor):
+            assert allclose(c, c_coarse)
+        for c, c_fine in zip(g.coor, fine.coor):
+            assert allclose(c, c_fine[::2])
+        grids = fine.refine().hierarchy()
+        assert [list(h.division) for h in grids][-1] == \
+               [d//2**(len(grids)-1) for d in grids[0].division]
+        assert len(fine.refine().hierarchy(2)) == 2
+    try:
+        UniformBoxGrid(min=(0,0), max=(1,1), division=(4,3)).coarsen()
+    except ValueError:
+        pass
+    else:
+        assert False, 'odd division not detected'
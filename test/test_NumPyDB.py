@@ -0,0 +1,300 @@
+import os
+import numpy
+from numpy import arange, linspace, allclose
+from scitools.NumPyDB import *
+from scitools.NumPyDB import _backends, _nearest
+
+def _dbname(tmpdir, name='db'):
+    return str(tmpdir.join(name))
+
+def test_roundtrip(tmpdir):
+    backends = dict(_backends)
+    backends['mmap-bz2'] = \
+        lambda name, mode: NumPyDB_mmap(name, mode, codec='bz2')
+    arrays = [linspace(0, 1, 7)*k for k in range(4)]
+    for backend in sorted(backends):
+        name = _dbname(tmpdir, backend)
+        db = backends[backend](name, 'store')
+        for k, a in enumerate(arrays):
+            db.dump(a, str(0.1*k))
+        # (a shelve database must be opened in load mode to be searched)
+        db = backends[backend](name, 'load')
+        for k, a in enumerate(arrays):
+            b, id = db.load(str(0.1*k))
+            assert id == str(0.1*k)
+            assert allclose(b, a), backend
+        assert db.load('nonexisting')[1] == 'not found'
+
+def test_mmap_dtypes(tmpdir):
+    arrays = [arange(12, dtype=numpy.int32).reshape(3,4),
+              arange(6, dtype=numpy.complex128),
+              numpy.zeros((2,0,3)),
+              numpy.asfortranarray(arange(6.).reshape(2,3))]
+    db = NumPyDB_mmap(_dbname(tmpdir))
+    for k, a in enumerate(arrays):
+        db.dump(a, str(k))
+    for k, a in enumerate(arrays):
+        b = db.load(str(k))[0]
+        assert isinstance(b, numpy.memmap) or b.size == 0
+        assert b.dtype == a.dtype and b.shape == a.shape
+        assert (b == a).all()
+    try:
+        db.dump(numpy.array([None, 1]), 'objects')
+    except TypeError:
+        pass
+    else:
+        assert False, 'object array not rejected'
+
+def test_duplicate_identifiers(tmpdir):
+    for backend in 'text', 'cPickle', 'mmap', 'mmap-zlib':
+        name = _dbname(tmpdir, backend)
+        db = _backends[backend](name, 'store')
+        db.dump(arange(3.), 't')
+        db.dump(arange(3.) + 10, 't')
+        db.dump(arange(3.) + 20, 'u')
+        db = _backends[backend](name, 'load')
+        # the first record with an identifier is the one loaded:
+        assert allclose(db.load('t')[0], arange(3.))
+        assert allclose(db.load(' u ')[0], arange(3.) + 20)
+
+def test_bestapprox_ties(tmpdir):
+    # float_dist has a key and uses a sorted index, linear_dist does not
+    def linear_dist(id1, id2):
+        return float_dist(id1, id2)
+    identifiers = ['0', '1', '2', '1.0', '3', '2', '0.5', '-1']
+    db = NumPyDB_cPickle(_dbname(tmpdir))
+    for k, id in enumerate(identifiers):
+        db.dump(numpy.array([k]), id)
+    db = NumPyDB_cPickle(_dbname(tmpdir), 'load')
+    for query in numpy.arange(-2, 4.5, 0.25):
+        query = repr(query)
+        if query in identifiers:  # (exact match)
+            continue
+        a, id = db.load(query, bestapprox=float_dist)
+        b, id_ref = db.load(query, bestapprox=linear_dist)
+        assert (id, a[0]) == (id_ref, b[0]), query
+        assert a[0] == _nearest({}, linear_dist, identifiers, query)
+    # ties are resolved in favor of the last stored record:
+    assert db.load('1.5', bestapprox=float_dist)[0][0] == 5
+    assert db.load('1.5', bestapprox=linear_dist)[0][0] == 5
+
+def test_load_many_range(tmpdir):
+    for backend in 'cPickle', 'shelve', 'mmap':
+        name = _dbname(tmpdir, backend)
+        db = _backends[backend](name, 'store')
+        for t in '0.5', '0', '2', '1', 'x', '1.5':
+            db.dump(arange(3.) + len(t), t)
+        db = _backends[backend](name, 'load')
+        result = db.load_many(['2', 'y', '0.5', '1.4'])
+        assert [id for a, id in result] == ['2', 'not found', '0.5',
+                                            'not found']
+        assert allclose(result[2][0], arange(3.) + 3)
+        result = db.load_range(0.5, 1.5)  # ('x' is skipped)
+        assert [id for a, id in result] == ['0.5', '1', '1.5']
+        assert allclose(result[1][0], arange(3.) + 1)
+        assert db.load_range(3, 4) == []
+
+def test_writer_mode(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_cPickle(name)
+    with db.open(buffering=2**16, flush_interval=3):
+        for k in range(10):
+            db.dump(arange(3.) + k, str(k))
+        try:
+            db.open()
+        except IOError:
+            pass
+        else:
+            assert False, 'second open not detected'
+        db.flush(fsync=True)
+        # flushed records can be loaded by other database objects:
+        assert NumPyDB_cPickle(name, 'load').load('9')[1] == '9'
+    assert db._fd is None
+    db = NumPyDB_cPickle(name, 'load')
+    assert allclose(db.load('7')[0], arange(3.) + 7)
+
+def test_async_dump(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_mmap(name)
+    db.start_async(max_queued_bytes=100)
+    a = arange(10.)
+    for k in range(20):
+        a[:] = k
+        db.dump(a, str(k))  # (a copy is queued)
+    db.flush()
+    assert (db.load('13')[0] == 13).all()
+    db.close()
+    db = NumPyDB_mmap(name, 'load')
+    assert (db.load('19')[0] == 19).all()
+
+def test_async_no_copy(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_mmap(name)
+    queued = []
+    db.start_async(copy=False)
+    db._async.put = lambda a, identifier: queued.append(a)
+    a = arange(4.)
+    db.dump(a, '0')
+    assert not queued[0].flags.writeable and a.flags.writeable
+    assert numpy.may_share_memory(queued[0], a)
+    db.close()
+
+def test_async_error(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_mmap(name)
+    db.open()
+    db.start_async()
+    dump = db._dump
+    def failing_dump(fd, a, identifier):
+        if identifier == 'bad':
+            raise IOError('disk full')
+        return dump(fd, a, identifier)
+    db._dump = failing_dump
+    db.dump(arange(3.), 'good')
+    db.dump(arange(3.), 'bad')
+    try:
+        db.close()
+    except IOError as e:
+        assert 'disk full' in str(e)
+    else:
+        assert False, 'the error in the async thread was not raised'
+    # the files are closed and the records before the error are stored:
+    assert db._fd is None and db._fm is None
+    db = NumPyDB_mmap(name, 'load')
+    assert (db.load('good')[0] == arange(3.)).all()
+    assert db.load('bad')[1] == 'not found'
+
+def _dump_mixed(name):
+    # dump records with and without compression (the second record
+    # with each identifier is never loaded)
+    db = NumPyDB_mmap(name)
+    arrays = {}
+    for k, codec in enumerate([None, 'zlib', None, 'bz2', 'zlib', None]):
+        db.codec = codec
+        a = arange(100.)*k
+        db.dump(a, str(5 - k))
+        arrays[str(5 - k)] = a
+        db.dump(a + 1, str(5 - k))
+    return db, arrays
+
+def _check_mixed(name, arrays):
+    db = NumPyDB_mmap(name, 'load')
+    for id in arrays:
+        a, found = db.load(id)
+        assert found == id
+        assert (a == arrays[id]).all()
+    assert isinstance(db.load('5')[0], numpy.memmap)      # plain
+    assert not isinstance(db.load('4')[0], numpy.memmap)  # zlib
+    return db
+
+def test_mixed_codecs(tmpdir):
+    name = _dbname(tmpdir)
+    db, arrays = _dump_mixed(name)
+    _check_mixed(name, arrays)
+    try:
+        NumPyDB_mmap(name, codec='nonexisting')
+    except ValueError:
+        pass
+    else:
+        assert False, 'illegal codec not detected'
+
+def test_compact(tmpdir):
+    name = _dbname(tmpdir)
+    db, arrays = _dump_mixed(name)
+    size = os.path.getsize(name + '.dat')
+    db.compact()
+    assert os.path.getsize(name + '.dat') < size
+    db = _check_mixed(name, arrays)
+    assert db._identifiers == ['0', '1', '2', '3', '4', '5']
+
+def test_compact_while_reading(tmpdir):
+    # a reader waiting for the lock on the map file while another
+    # database object compacts must read the new map file
+    import scitools.NumPyDB
+    name = _dbname(tmpdir)
+    db, arrays = _dump_mixed(name)
+    loader = NumPyDB_mmap(name, 'load')
+    loader.index_file_threshold = 1
+    loader.load('0')
+    assert os.path.isfile(name + '.idx')
+    reader = NumPyDB_mmap(name, 'load')
+    lock = scitools.NumPyDB._lock
+    def compact_and_lock(f, exclusive):
+        scitools.NumPyDB._lock = lock
+        db.compact()
+        lock(f, exclusive)
+    scitools.NumPyDB._lock = compact_and_lock
+    try:
+        a, id = reader.load('4')
+    finally:
+        scitools.NumPyDB._lock = lock
+    assert id == '4' and (a == arrays['4']).all()
+    assert not os.path.isfile(name + '.idx')
+    _check_mixed(name, arrays)
+
+def test_dump_then_load(tmpdir):
+    # a load between dumps must not hide the records dumped after it
+    for backend in 'text', 'pickle', 'mmap':
+        db = _backends[backend](_dbname(tmpdir, backend), 'store')
+        db.dump(arange(3.), 'a')
+        assert db.load('a')[1] == 'a'
+        db.dump(arange(2.), 'b')
+        assert db.load('b')[1] == 'b'
+        db.open()
+        db.dump(arange(2.), 'c')
+        db.flush()
+        assert db.load('c')[1] == 'c'
+        db.close()
+
+def test_index_file(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_mmap(name)
+    db.open()
+    for k in range(20):
+        db.dump(arange(3.) + k, str(k))
+    db.close()
+    db = NumPyDB_mmap(name, 'load')
+    db.index_file_threshold = 10
+    assert db.load('7')[1] == '7'
+    assert os.path.isfile(name + '.idx')
+
+    # reopen from the index file:
+    db = NumPyDB_mmap(name, 'load')
+    stat = os.stat(db.pn)
+    assert db._read_index_file(stat.st_size, stat.st_mtime)
+    assert db._identifiers == [str(k) for k in range(20)]
+    assert (db.load('19')[0] == arange(3.) + 19).all()
+    assert db.load('1.4', bestapprox=float_dist)[1] == '1'
+
+    # a stale index file (the map file has changed) is ignored:
+    db.dump(arange(3.) - 1, '20')
+    db = NumPyDB_mmap(name, 'load')
+    assert (db.load('20')[0] == arange(3.) - 1).all()
+    assert len(db._identifiers) == 21
+
+def test_truncated_map_line(tmpdir):
+    name = _dbname(tmpdir)
+    db = NumPyDB_mmap(name)
+    db.dump(arange(3.), 'a')
+    db.dump(arange(4.), 'b')
+    f = open(name + '.map', 'a')
+    f.write('123456 c')  # half-written line (no newline)
+    f.close()
+    db = NumPyDB_mmap(name, 'load')
+    assert db._identifiers == ['a', 'b']
+    assert db.load('c')[1] == 'not found'
+    assert (db.load('b')[0] == arange(4.)).all()
+
+def test_benchmark_suite(tmpdir):
+    from StringIO import StringIO
+    import json
+    out = StringIO()
+    results = benchmark_suite(['mmap', 'nonexisting'], nrecords=(3,),
+                              lengths=(5,), outfile=out,
+                              name=_dbname(tmpdir, 'benchmark'))
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == \
+           results
+    assert results[0]['backend'] == 'mmap' and results[0]['nrecords'] == 3
+    assert 'error' not in results[0] and results[0]['load_MBps'] > 0
+    assert 'error' in results[1]
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,164 @@
+import os, glob, time
+import numpy
+from numpy import arange, allclose
+from StringIO import StringIO
+import scitools.filetable as ft
+
+def _table(nrows, ncolumns):
+    return arange(nrows*ncolumns, dtype=float).reshape(nrows, ncolumns)/7
+
+def _two_blocks():
+    f = StringIO()
+    f.write('# first block\n')
+    ft.write(f, _table(5, 3), precision=17)
+    f.write('\n# second block\n#\n')
+    ft.write(f, _table(4, 2) + 1, precision=17)
+    f.seek(0)
+    return f
+
+def test_iter_blocks():
+    f = _two_blocks()
+    chunks = [chunk.copy() for chunk in ft.iter_blocks(f, chunk_rows=2)]
+    assert [c.shape for c in chunks] == [(2, 3), (2, 3), (1, 3)]
+    assert allclose(numpy.concatenate(chunks), _table(5, 3))
+    # the file is positioned at the next data set:
+    chunks = list(ft.iter_blocks(f, chunk_rows=10))
+    assert len(chunks) == 1 and allclose(chunks[0], _table(4, 2) + 1)
+    assert list(ft.iter_blocks(f)) == []
+    try:
+        list(ft.iter_blocks(StringIO('1 2\n3\n')))
+    except ValueError:
+        pass
+    else:
+        assert False, 'rows of different lengths not detected'
+
+def test_cache(tmpdir):
+    filename = str(tmpdir.join('table.dat'))
+    a = _table(20, 3)
+    ft.writefile(filename, a, precision=17)
+    x, y, z = ft.readfile(filename, cache=True)
+    assert not isinstance(x, numpy.memmap)
+    sidecars = glob.glob(filename + '.cache-*.npy')
+    assert len(sidecars) == 1
+
+    # a cache hit gives memory-mapped, writable columns:
+    x, y, z = ft.readfile(filename, cache=True)
+    assert isinstance(x, numpy.memmap)
+    assert (x == a[:,0]).all() and (z == a[:,2]).all()
+    x[0] = -1  # (not written back to the sidecar)
+    assert ft.readfile(filename, cache=True)[0][0] == 0
+    f = open(filename)
+    ft.read_columns(f, cache=True)
+    assert f.read() == ''  # as after parsing the file
+    f.close()
+
+    # a modified file invalidates the cache and the old sidecar is removed:
+    time.sleep(0.01)
+    ft.writefile(filename, a[:10] + 1, precision=17)
+    x, y, z = ft.readfile(filename, cache=True)
+    assert not isinstance(x, numpy.memmap) and len(x) == 10
+    assert (y == a[:10,1] + 1).all()
+    assert not os.path.isfile(sidecars[0])
+    assert len(glob.glob(filename + '.cache-*.npy')) == 1
+
+def test_usecols_all_blocks(tmpdir):
+    f = _two_blocks()
+    assert (ft.read(f, usecols=(2, 0)) == _table(5, 3)[:,[2,0]]).all()
+    f.seek(0)
+    blocks = ft.read(f, all_blocks=True)
+    assert [b.shape for b in blocks] == [(5, 3), (4, 2)]
+    assert allclose(blocks[1], _table(4, 2) + 1)
+    f.seek(0)
+    columns = ft.read_columns(f, usecols=[1], all_blocks=True)
+    assert [len(c) for c in columns] == [1, 1]
+    assert allclose(columns[1][0], _table(4, 2)[:,1] + 1)
+
+    # usecols selects from the cached columns:
+    filename = str(tmpdir.join('table.dat'))
+    ft.writefile(filename, _table(5, 3), precision=17)
+    for i in range(2):
+        z, x = ft.readfile(filename, cache=True, usecols=[2, 0])
+        assert (z == _table(5, 3)[:,2]).all()
+    try:
+        ft.readfile(filename, cache=True, all_blocks=True)
+    except ValueError:
+        pass
+    else:
+        assert False, 'cache with all_blocks not detected'
+
+def test_read_write():
+    a = _table(10, 4)
+    f = StringIO()
+    ft.write(f, a, precision=17)
+    f.seek(0)
+    assert (ft.read(f) == a).all()
+
+def test_write_chunks():
+    # rows from several format chunks of write, compared with write_v3
+    for nrows, ncolumns in (3000, 3), (1500, 100), (70000, 1):
+        a = _table(nrows, ncolumns)
+        f = StringIO()
+        ft.write(f, a)
+        f_ref = StringIO()
+        ft.write_v3(f_ref, a)
+        assert f.getvalue() == f_ref.getvalue()
+        assert f.getvalue().count('\n') == nrows
+
+def test_write_fmt():
+    a = numpy.array([[1, 2.5], [3, 1/3.]])
+    f = StringIO()
+    ft.write(f, a, fmt=['%d', '%.2f'], delimiter=', ')
+    assert f.getvalue() == '1, 2.50\n3, 0.33\n'
+    f = StringIO()
+    ft.write(f, a, precision=3)
+    assert f.getvalue() == '1\t2.5\n3\t0.333\n'
+    try:
+        ft.write(f, a, fmt=['%g'])
+    except ValueError:
+        pass
+    else:
+        assert False, 'wrong number of formats not detected'
+
+def test_gzip(tmpdir):
+    filename = str(tmpdir.join('table.dat.gz'))
+    a = _table(30, 2)
+    ft.writefile(filename, a, fmt='%.10e')
+    assert open(filename, 'rb').read(2) == '\x1f\x8b'
+    x, y = ft.readfile(filename)
+    assert allclose(x, a[:,0], rtol=1E-9) and allclose(y, a[:,1], rtol=1E-9)
+    x, y = ft.readfile(filename, cache=True)
+    x, y = ft.readfile(filename, cache=True)
+    assert isinstance(y, numpy.memmap) and allclose(y, a[:,1], rtol=1E-9)
+
+def test_parallel_read(tmpdir):
+    filename = str(tmpdir.join('table.dat'))
+    a = _table(1000, 3)
+    ft.writefile(filename, a, precision=17)
+    threshold = ft.parallel_threshold
+    ft.parallel_threshold = 1000
+    try:
+        for nprocs in 1, 3, None:
+            f = open(filename)
+            assert (ft.read(f, nprocs=nprocs, usecols=(2, 1)) ==
+                    a[:,[2,1]]).all()
+            f.close()
+    finally:
+        ft.parallel_threshold = threshold
+
+def _read_all(args):
+    filename, threshold = args
+    ft.parallel_threshold = threshold
+    return ft.read(open(filename), nprocs=None)
+
+def test_parallel_read_in_pool(tmpdir):
+    # Pool workers cannot start their own pools and read serially
+    import multiprocessing
+    filename = str(tmpdir.join('table.dat'))
+    a = _table(1000, 3)
+    ft.writefile(filename, a, precision=17)
+    pool = multiprocessing.Pool(1)
+    try:
+        assert (pool.map(_read_all, [(filename, 1000)])[0] == a).all()
+    finally:
+        pool.close()
+        pool.join()